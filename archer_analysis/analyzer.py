@@ -6,8 +6,29 @@ import abc
 
 import iris
 
+from utils import CubeIndex, get_pyplot
+from cube_cache import CUBE_CACHE
+from instrumentation import Timings
+from output import OutputOptions, save_cubes
+from fieldsfile import FieldsFileIndex, is_fieldsfile
+from memory_estimates import field_shapes, shapes_nbytes
+from manifest import file_identity, config_hash, read_manifest, write_manifest
+
 class Analyzer(object):
     __metaclass__ = abc.ABCMeta
+    # ids of the cubes this analyzer reads from another analyzer's results, and of the cubes
+    # that it produces for others. Used by RunControl to link analyzers together.
+    inputs = ()
+    outputs = ()
+    # STASH (section, item) codes of the fields this analyzer reads from file.
+    # If neither fields nor inputs are given, load reads every field.
+    fields = ()
+    # Increase when a change to an analyzer changes its results, so they are recomputed.
+    version = 1
+    # Peak memory of the analysis, as a multiple of the size of the fields it reads.
+    memory_factor = 2.
+    # Whether plot makes any figures, so that the render stage knows which jobs to render.
+    has_plots = False
 
     @staticmethod
     def get_files(data_dir, filename):
@@ -40,46 +61,158 @@ class Analyzer(object):
 
         self.results = OrderedDict()
 	self.force = False
+	self.checksum = False
+	# Read declared fields of UM fieldsfiles through their lookup table, not iris.load.
+	self.native_reader = False
+	self.persist_index = False
+	self._config = {}
 	self.logname = self.filename + '.analyzed'
+	self.manifest_filename = os.path.join(self.results_dir, self.output_filename + '.manifest')
+	self.timings = Timings()
+	self.output_options = OutputOptions()
 
     def set_config(self, config):
 	self._config = config
 	if 'force' in self._config:
 	    self.force = self._config['force'] == 'True'
+	if 'checksum' in self._config:
+	    self.checksum = self._config['checksum'] == 'True'
+	if 'native_reader' in self._config:
+	    self.native_reader = self._config['native_reader'] == 'True'
+	if 'persist_index' in self._config:
+	    self.persist_index = self._config['persist_index'] == 'True'
+	self.output_options = OutputOptions.from_config(self._config)
+
+    def manifest(self):
+        """What the results depend on: the input file, analyzer version and config."""
+        return {
+            'analysis': self.analysis_name,
+            'input': file_identity(self.filename, self.checksum),
+            'version': self.version,
+            'config_hash': config_hash(self._config),
+        }
 
     def already_analyzed(self):
-        return os.path.exists(self.logname)
+        """Whether the saved results are up to date with the input file, version and config."""
+        previous_manifest = read_manifest(self.manifest_filename)
+        if previous_manifest is None:
+            # Results saved before manifests were written, which were all made by version 1.
+            return os.path.exists(self.logname) and self.version == 1
+        if not os.path.exists(self.filename):
+            return False
+        return previous_manifest == self.manifest()
+
+    def estimate_memory(self):
+        """Rough peak memory of this analysis in bytes, from its file's metadata only."""
+        if not os.path.exists(self.filename):
+            # Input from an upstream analysis, which has not been run yet.
+            return 0
+        shapes = field_shapes(self.filename, self.fields) if self.fields else None
+        if shapes is None:
+            nbytes = os.path.getsize(self.filename)
+        else:
+            nbytes = shapes_nbytes(shapes)
+        return int(nbytes * self.memory_factor)
 
     def append_log(self, message):
         with open(self.logname, 'a') as f:
             f.write('{}: {}\n'.format(dt.datetime.now(), message))
 
+    def span(self, name):
+        """Context manager timing a stage; use in run_analysis for e.g. with self.span('label_blobs')."""
+        return self.timings.span(name)
+
+    def timing_records(self):
+        return self.timings.records(analysis=self.analysis_name, filename=self.filename)
+
+    def load_constraints(self):
+        """Constraints that select only the declared fields and inputs, or None for everything."""
+        constraints = []
+        if self.fields:
+            fields = set(self.fields)
+            constraints.append(iris.AttributeConstraint(
+                STASH=lambda stash: (stash.section, stash.item) in fields))
+        if self.inputs:
+            inputs = set(self.inputs)
+            constraints.append(iris.AttributeConstraint(id=lambda id: id in inputs))
+        return constraints or None
+
+    def read_cubes(self):
+        """Read this analyzer's fields and inputs from its file."""
+        if self.native_reader and self.fields and is_fieldsfile(self.filename):
+            index = FieldsFileIndex.open(self.filename, self.persist_index)
+            return index.load_cubes(self.fields)
+        return iris.load(self.filename, self.load_constraints())
+
+    def set_cubes(self, cubes):
+        self.cubes = cubes
+        self.cube_index = CubeIndex(cubes)
+
     def load(self):
         self.append_log('Loading')
-        self.cubes = iris.load(self.filename)
+        fields_key = (tuple(sorted(self.fields)), tuple(sorted(self.inputs)))
+        self._manifest = self.manifest()
+        with self.span('load'):
+            self.set_cubes(CUBE_CACHE.load(self.filename, self.read_cubes, fields_key))
         self.append_log('Loaded')
 
+    def load_from(self, upstream):
+        """Use the results of upstream analyzer directly, instead of loading them from file."""
+        self.append_log('Using results from {}'.format(upstream.name))
+        self._manifest = self.manifest()
+        self.set_cubes(iris.cube.CubeList(upstream.results.values()))
+
     def run(self):
         self.append_log('Analyzing')
-	self.run_analysis()
+        with self.span('run'):
+            self.run_analysis()
         self.append_log('Analyzed')
 
     def save(self):
         self.append_log('Saving')
+        with self.span('save'):
+            self._save()
+        self.append_log('Saved')
+
+    def _save(self):
         if not os.path.exists(self.results_dir):
             os.makedirs(self.results_dir)
 
         cubelist_filename = os.path.join(self.results_dir, self.output_filename)
         cubelist = iris.cube.CubeList(self.results.values())
 
-        iris.save(cubelist, cubelist_filename)
+        save_cubes(cubelist, cubelist_filename, self.output_options)
 
-	self.save_analysis()
-        self.append_log('Saved')
+	with self.span('save_analysis'):
+	    self.save_analysis()
+	# Record what the results came from (as it was when loaded).
+	write_manifest(self.manifest_filename, self._manifest)
 
     def save_analysis(self):
 	pass
 
+    def render(self):
+        """Make this analysis's figures, from its saved results only."""
+        results_filename = os.path.join(self.results_dir, self.output_filename)
+        if not os.path.exists(results_filename):
+            raise Exception('No results to render: {}'.format(results_filename))
+        manifest = read_manifest(self.manifest_filename)
+        results_version = manifest['version'] if manifest else 1
+        if results_version != self.version:
+            raise Exception('Results {} were made by version {} of {}, not {}: run the analysis '
+                            'again to remake them'.format(results_filename, results_version,
+                                                          self.analysis_name, self.version))
+        with self.span('render'):
+            plt = get_pyplot()
+            try:
+                self.plot(plt, CubeIndex(iris.load(results_filename)))
+            finally:
+                plt.close('all')
+
+    def plot(self, plt, results):
+        """Make figures in results_dir from results, a CubeIndex of the saved results."""
+        pass
+
     @abc.abstractmethod
     def run_analysis(self):
         return
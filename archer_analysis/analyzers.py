@@ -1,16 +1,42 @@
-"""Provide an easy way of getting analyzer classes by name"""
-from surf_flux_analysis import SurfFluxAnalyzer
-from restart_dump_analysis import RestartDumpAnalyzer
-from profile_analysis import ProfileAnalyzer
-from cloud_analysis import CloudAnalyzer
-from mass_flux_analysis import MassFluxAnalyzer
-from mass_flux_spatial_scales_analysis import MassFluxSpatialScalesAnalyzer
-
-ANALYZERS = {
-    SurfFluxAnalyzer.analysis_name: SurfFluxAnalyzer,
-    RestartDumpAnalyzer.analysis_name: RestartDumpAnalyzer,
-    ProfileAnalyzer.analysis_name: ProfileAnalyzer,
-    CloudAnalyzer.analysis_name: CloudAnalyzer,
-    MassFluxAnalyzer.analysis_name: MassFluxAnalyzer,
-    MassFluxSpatialScalesAnalyzer.analysis_name: MassFluxSpatialScalesAnalyzer,
-}
+"""Provide an easy way of getting analyzer classes by name
+
+Analyzer modules are only imported when their class is first looked up, so that a task that
+runs one analysis does not pay for importing all the others.
+"""
+import collections
+import importlib
+
+# analysis_name: (module, class name)
+ANALYZER_CLASSES = collections.OrderedDict([
+    ('surf_flux_analysis', ('surf_flux_analysis', 'SurfFluxAnalyzer')),
+    ('restart_dump_analysis', ('restart_dump_analysis', 'RestartDumpAnalyzer')),
+    ('profile_analysis', ('profile_analysis', 'ProfileAnalyzer')),
+    ('cloud_analysis', ('cloud_analysis', 'CloudAnalyzer')),
+    ('mass_flux_analysis', ('mass_flux_analysis', 'MassFluxAnalyzer')),
+    ('mass_flux_spatial_scales_analysis', ('mass_flux_spatial_scales_analysis',
+                                           'MassFluxSpatialScalesAnalyzer')),
+])
+
+
+class AnalyzerRegistry(collections.Mapping):
+    """Read-only mapping of analysis_name to analyzer class, importing each class when first used."""
+    def __init__(self, classes):
+        self._classes = classes
+        self._loaded = {}
+
+    def __getitem__(self, analysis_name):
+        if analysis_name not in self._loaded:
+            module_name, class_name = self._classes[analysis_name]
+            Analyzer = getattr(importlib.import_module(module_name), class_name)
+            assert Analyzer.analysis_name == analysis_name
+            self._loaded[analysis_name] = Analyzer
+        return self._loaded[analysis_name]
+
+    def __iter__(self):
+        return iter(self._classes)
+
+    def __len__(self):
+        return len(self._classes)
+
+
+ANALYZERS = AnalyzerRegistry(ANALYZER_CLASSES)
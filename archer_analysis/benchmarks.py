@@ -0,0 +1,171 @@
+"""Time and measure peak memory of the analyzers and utilities on synthetic data.
+
+e.g. python benchmarks.py --sizes 64,256,1024 --ntimes 1,4 --output bench.jsonl
+
+Each benchmark is run in a fresh process, so that its peak RSS is its own. Results are
+printed as a table and optionally appended to a file as JSON lines, so that runs on
+different versions of the code can be compared.
+"""
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import resource
+import traceback
+import datetime as dt
+from multiprocessing import Pool
+
+import numpy as np
+
+from analyzers import ANALYZERS
+from synthetic_data import make_analyzer_cubes, theta_heights
+from utils import count_blobs_mask, blob_stats, coarse_grain, mass_weighted_vertical_integrals
+
+# Config needed by analyzers that cannot be run with an empty one.
+ANALYZER_CONFIG = {
+    'cloud_analysis': {'height_level': '1', 'w_thresh': '1', 'qcl_thresh': '0.0001'},
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _cloud_mask(size, seed=0):
+    rs = np.random.RandomState(seed)
+    return rs.uniform(size=(size, size)) > 0.95
+
+
+def bench_count_blobs_mask(size, ntimes, nz):
+    masks = [_cloud_mask(size, i) for i in range(ntimes)]
+    return lambda: [count_blobs_mask(mask, True) for mask in masks]
+
+
+def bench_blob_stats(size, ntimes, nz):
+    masks = [_cloud_mask(size, i) for i in range(ntimes)]
+    labelled = [count_blobs_mask(mask, True) for mask in masks]
+    w = np.random.RandomState(0).standard_normal((size, size))
+    return lambda: [blob_stats(blobs, max_blob_index, w) for max_blob_index, blobs in labelled]
+
+
+def bench_coarse_grain(size, ntimes, nz):
+    masks = [_cloud_mask(size, i) for i in range(ntimes)]
+    w = np.random.RandomState(0).standard_normal((size, size))
+    return lambda: [coarse_grain(w, mask) for mask in masks]
+
+
+def bench_mass_weighted_vertical_integrals(size, ntimes, nz):
+    rs = np.random.RandomState(0)
+    rho = rs.uniform(size=(nz, size, size)).astype(np.float32)
+    qvars = [rs.uniform(size=(nz + 1, size, size)).astype(np.float32) for _ in range(5)]
+    dz = np.diff(theta_heights(nz))
+    return lambda: mass_weighted_vertical_integrals(rho, qvars, dz)
+
+
+def bench_analyzer(analysis):
+    def setup(size, ntimes, nz):
+        Analyzer = ANALYZERS[analysis]
+        cubes = make_analyzer_cubes(Analyzer, nz, size, size, ntimes)
+        for cube in cubes:
+            # Realise here, so that making the data is not counted as analysis time.
+            cube.data
+        tmpdir = tempfile.mkdtemp()
+        analyzer = Analyzer('bench', 'bench', 'bench', 'datam', tmpdir, tmpdir, 'atmos.000.pp1')
+        analyzer.set_config(ANALYZER_CONFIG.get(analysis, {}))
+
+        def run():
+            try:
+                analyzer.set_cubes(cubes)
+                analyzer.run()
+            finally:
+                shutil.rmtree(tmpdir)
+        return run
+    return setup
+
+
+BENCHMARKS = [
+    ('count_blobs_mask', bench_count_blobs_mask),
+    ('blob_stats', bench_blob_stats),
+    ('coarse_grain', bench_coarse_grain),
+    ('mass_weighted_vertical_integrals', bench_mass_weighted_vertical_integrals),
+] + [(analysis, bench_analyzer(analysis)) for analysis in sorted(ANALYZERS)]
+
+
+def run_benchmark(args):
+    """Run one benchmark; returns a dict record. Meant to be run in a fresh process."""
+    name, size, ntimes, nz = args
+    record = {'name': name, 'size': size, 'ntimes': ntimes, 'nz': nz}
+    try:
+        run = dict(BENCHMARKS)[name](size, ntimes, nz)
+        rss_before = peak_rss_mb()
+        start_wall = time.time()
+        start_cpu = time.clock()
+        run()
+        record['wall_s'] = time.time() - start_wall
+        record['cpu_s'] = time.clock() - start_cpu
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['setup_peak_rss_mb'] = rss_before
+    except Exception:
+        record['error'] = traceback.format_exc()
+    return record
+
+
+def run_benchmarks(names, sizes, ntimes_list, nz):
+    records = []
+    for name, _ in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for size in sizes:
+            for ntimes in ntimes_list:
+                # maxtasksperchild=1: a new process per benchmark, so peak RSS is not shared.
+                pool = Pool(1, maxtasksperchild=1)
+                try:
+                    record = pool.apply(run_benchmark, ((name, size, ntimes, nz),))
+                finally:
+                    pool.close()
+                    pool.join()
+                print_record(record)
+                records.append(record)
+    return records
+
+
+def print_record(record):
+    if 'error' in record:
+        print('{name:<36} {size:>6} {ntimes:>6} FAILED'.format(**record))
+        print(record['error'])
+    else:
+        print('{name:<36} {size:>6} {ntimes:>6} {wall_s:>10.3f} {cpu_s:>10.3f} {peak_rss_mb:>12.1f}'
+              .format(**record))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='64,256', help='comma separated grid sizes')
+    parser.add_argument('--ntimes', default='1,4', help='comma separated numbers of time steps')
+    parser.add_argument('--nz', type=int, default=20, help='number of (rho) levels')
+    parser.add_argument('--only', default='', help='comma separated benchmark names to run')
+    parser.add_argument('--output', help='file to append JSON line records to')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    ntimes_list = [int(n) for n in args.ntimes.split(',')]
+    names = [n for n in args.only.split(',') if n]
+
+    print('{:<36} {:>6} {:>6} {:>10} {:>10} {:>12}'.format(
+        'benchmark', 'size', 'ntimes', 'wall (s)', 'cpu (s)', 'peak RSS (MB)'))
+    records = run_benchmarks(names, sizes, ntimes_list, args.nz)
+
+    if args.output:
+        timestamp = dt.datetime.now().isoformat()
+        with open(args.output, 'a') as f:
+            for record in records:
+                record['timestamp'] = timestamp
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+    return 1 if any('error' in record for record in records) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
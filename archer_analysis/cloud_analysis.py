@@ -1,8 +1,5 @@
 import os
 
-import matplotlib
-matplotlib.use('Agg')
-import pylab as plt
 import iris
 
 from analyzer import Analyzer
@@ -12,6 +9,8 @@ from consts import Re, L, cp, g
 
 class CloudAnalyzer(Analyzer):
     analysis_name = 'cloud_analysis'
+    outputs = ('w', 'qcl', 'w_mask', 'qcl_mask', 'cloud_mask')
+    fields = ((0, 150), (0, 254))
 
     def set_config(self, config):
 	super(CloudAnalyzer, self).set_config(config)
@@ -20,33 +19,32 @@ class CloudAnalyzer(Analyzer):
 	self.qcl_thresh = float(config['qcl_thresh'])
 	    
     def run_analysis(self):
-        cubes = self.cubes
+        cubes = self.cube_index
 
-        w = get_cube(cubes, 0, 150)
+        # Slicing keeps the data lazy: only the one level used is ever read from file.
+        w = get_cube(cubes, 0, 150)[:, self.height_level]
 	w.attributes['id'] = 'w'
-        qcl = get_cube(cubes, 0, 254)
+        qcl = get_cube(cubes, 0, 254)[:, self.height_level]
 	qcl.attributes['id'] = 'qcl'
 
-	w_mask = w[:, self.height_level].data > self.w_thresh
-	qcl_mask = qcl[:, self.height_level].data > self.qcl_thresh
+	w_mask = w.data > self.w_thresh
+	qcl_mask = qcl.data > self.qcl_thresh
 
-        w_mask_cube = w.slices_over('model_level_number').next().copy()
-	w_mask_cube.data = w_mask.astype(int)
+	# copy(data=...) takes the coords etc. from the level's cube without copying its data.
+        w_mask_cube = w.copy(data=w_mask.astype(int))
         w_mask_cube.rename('w mask w>{}'.format(self.w_thresh))
 	w_mask_cube.attributes['id'] = 'w_mask'
 
-        qcl_mask_cube = qcl.slices_over('model_level_number').next().copy()
-	qcl_mask_cube.data = qcl_mask.astype(int)
+        qcl_mask_cube = qcl.copy(data=qcl_mask.astype(int))
         qcl_mask_cube.rename('qcl mask qcl>{}'.format(self.qcl_thresh))
 	qcl_mask_cube.attributes['id'] = 'qcl_mask'
 
-        cloud_mask_cube = qcl.slices_over('model_level_number').next().copy()
-	cloud_mask_cube.data = (w_mask & qcl_mask).astype(int)
+        cloud_mask_cube = qcl.copy(data=(w_mask & qcl_mask).astype(int))
         cloud_mask_cube.rename('Cloud mask w>{}, qcl>{}'.format(self.w_thresh, self.qcl_thresh))
 	cloud_mask_cube.attributes['id'] = 'cloud_mask'
 
-	self.results['w'] = w[:, self.height_level].copy()
-	self.results['qcl'] = qcl[:, self.height_level].copy()
+	self.results['w'] = w
+	self.results['qcl'] = qcl
 	self.results['w_mask'] = w_mask_cube
 	self.results['qcl_mask'] = qcl_mask_cube
 	self.results['cloud_mask'] = cloud_mask_cube
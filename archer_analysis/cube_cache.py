@@ -0,0 +1,57 @@
+"""Process-wide cache of loaded cubes, so that a file used by several analyzers is read once."""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import iris
+
+
+def cubes_nbytes(cubes):
+    """Memory the cubes' data takes (or will take, for lazy data) once realised."""
+    return sum(int(np.prod(cube.shape)) * cube.dtype.itemsize for cube in cubes)
+
+
+class CubeCache(object):
+    """Least recently used cache of iris.load results, limited to max_bytes of cube data.
+
+    Entries are keyed on (path, mtime, fields_key), so a file that has changed since it was
+    loaded is read again. Cached cubes are shared between everything that loads them, so
+    must not be modified in place. A max_bytes of 0 disables the cache.
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def load(self, filename, load_cubes, fields_key=None):
+        """Cubes from filename, calling load_cubes() to read them if they are not cached."""
+        key = (os.path.abspath(filename), os.path.getmtime(filename), fields_key)
+        if key in self._entries:
+            self.hits += 1
+            cubes, nbytes = self._entries.pop(key)
+            self._entries[key] = (cubes, nbytes)
+            return iris.cube.CubeList(cubes)
+
+        self.misses += 1
+        cubes = load_cubes()
+        self._add(key, cubes)
+        return cubes
+
+    def _add(self, key, cubes):
+        nbytes = cubes_nbytes(cubes)
+        if nbytes > self.max_bytes:
+            return
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+        self._entries[key] = (iris.cube.CubeList(cubes), nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+
+CUBE_CACHE = CubeCache()
@@ -0,0 +1,249 @@
+"""Mergeable summaries of distributions of values: fixed bin histograms and quantile sketches.
+
+Both can be accumulated a batch of values at a time, saved as cubes, and merged with others
+of the same kind, so that distributions over a whole run can be built in constant memory.
+iris is only imported to make or save cubes, so the accumulators can be used without it.
+"""
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+QUANTILES = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+
+def _finite_values(values):
+    if np.ma.isMaskedArray(values):
+        values = values.compressed()
+    values = np.asarray(values).ravel()
+    return values[np.isfinite(values)]
+
+
+class FixedBinHistogram(object):
+    """Counts of values in the bins between bin_edges, plus counts below and above them.
+
+    Bins include their lower edge and exclude their upper edge.
+    """
+    def __init__(self, bin_edges):
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        # counts[0] is below bin_edges[0], counts[-1] is at or above bin_edges[-1].
+        self.counts = np.zeros(len(self.bin_edges) + 1, dtype=np.int64)
+
+    def add(self, values):
+        values = _finite_values(values)
+        indices = np.searchsorted(self.bin_edges, values, side='right')
+        self.counts += np.bincount(indices, minlength=len(self.counts))
+
+    def merge(self, other):
+        if not np.array_equal(self.bin_edges, other.bin_edges):
+            raise Exception('Cannot merge histograms with different bin edges')
+        self.counts += other.counts
+
+    def to_cube(self, name, units, cube_id):
+        import iris
+        bin_coord = iris.coords.DimCoord(np.arange(len(self.counts)), long_name='bin_index')
+        lower = np.concatenate([[-np.inf], self.bin_edges])
+        upper = np.concatenate([self.bin_edges, [np.inf]])
+        cube = iris.cube.Cube(self.counts, long_name=name, units='1',
+                              dim_coords_and_dims=[(bin_coord, 0)])
+        cube.add_aux_coord(iris.coords.AuxCoord(lower, long_name='bin_lower_edge', units=units), 0)
+        cube.add_aux_coord(iris.coords.AuxCoord(upper, long_name='bin_upper_edge', units=units), 0)
+        cube.attributes['id'] = cube_id
+        cube.attributes['distribution'] = 'histogram'
+        return cube
+
+    @classmethod
+    def from_cube(cls, cube):
+        histogram = cls(cube.coord('bin_lower_edge').points[1:])
+        histogram.counts[:] = cube.data
+        return histogram
+
+
+class QuantileSketch(object):
+    """Sketch of a distribution giving quantiles to within relative_accuracy of the true value.
+
+    Values are counted in logarithmically sized bins (as in DDSketch), so that any two
+    sketches with the same relative_accuracy can be merged by adding counts.
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # Counts of positive and negative values, keyed on bin index, and of zeros.
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+
+    @property
+    def count(self):
+        return sum(self.positive.values()) + sum(self.negative.values()) + self.zero_count
+
+    def _add_to_store(self, store, magnitudes):
+        indices = np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64)
+        for index, count in zip(*np.unique(indices, return_counts=True)):
+            store[int(index)] = store.get(int(index), 0) + int(count)
+
+    def add(self, values):
+        values = _finite_values(values)
+        self._add_to_store(self.positive, values[values > 0])
+        self._add_to_store(self.negative, -values[values < 0])
+        self.zero_count += int((values == 0).sum())
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise Exception('Cannot merge sketches with different relative accuracies')
+        for store, other_store in [(self.positive, other.positive),
+                                   (self.negative, other.negative)]:
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+        self.zero_count += other.zero_count
+
+    def _bin_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        """Estimate of the q quantile (0 <= q <= 1), or nan if nothing has been added."""
+        count = self.count
+        if not count:
+            return np.nan
+        rank = q * (count - 1)
+        # Go through the bins from the most negative value to the most positive.
+        bins = ([(-self._bin_value(i), self.negative[i])
+                 for i in sorted(self.negative, reverse=True)] +
+                [(0., self.zero_count)] +
+                [(self._bin_value(i), self.positive[i]) for i in sorted(self.positive)])
+        seen = 0
+        for value, bin_count in bins:
+            seen += bin_count
+            if seen > rank:
+                return value
+        return bins[-1][0]
+
+    def to_cube(self, name, units, cube_id):
+        import iris
+        # The zero bin is always included, so that the cube is never empty.
+        signs = ([-1] * len(self.negative) + [0] + [1] * len(self.positive))
+        indices = sorted(self.negative) + [0] + sorted(self.positive)
+        counts = ([self.negative[i] for i in sorted(self.negative)] + [self.zero_count] +
+                  [self.positive[i] for i in sorted(self.positive)])
+        bin_coord = iris.coords.DimCoord(np.arange(len(counts)), long_name='sketch_bin')
+        cube = iris.cube.Cube(np.array(counts, dtype=np.int64), long_name=name, units='1',
+                              dim_coords_and_dims=[(bin_coord, 0)])
+        cube.add_aux_coord(iris.coords.AuxCoord(np.array(signs, dtype=np.int8),
+                                                long_name='sketch_sign'), 0)
+        cube.add_aux_coord(iris.coords.AuxCoord(np.array(indices, dtype=np.int32),
+                                                long_name='sketch_index'), 0)
+        cube.attributes['id'] = cube_id
+        cube.attributes['distribution'] = 'sketch'
+        cube.attributes['relative_accuracy'] = self.relative_accuracy
+        cube.attributes['values_units'] = str(units)
+        return cube
+
+    @classmethod
+    def from_cube(cls, cube):
+        sketch = cls(float(cube.attributes['relative_accuracy']))
+        signs = cube.coord('sketch_sign').points
+        indices = cube.coord('sketch_index').points
+        for sign, index, count in zip(signs, indices, cube.data):
+            if sign > 0:
+                sketch.positive[int(index)] = int(count)
+            elif sign < 0:
+                sketch.negative[int(index)] = int(count)
+            else:
+                sketch.zero_count = int(count)
+        return sketch
+
+    def quantiles_cube(self, name, units, cube_id, quantiles=QUANTILES):
+        import iris
+        quantile_coord = iris.coords.DimCoord(quantiles, long_name='quantile', units='1')
+        cube = iris.cube.Cube(np.array([self.quantile(q) for q in quantiles]), long_name=name,
+                              units=units, dim_coords_and_dims=[(quantile_coord, 0)])
+        cube.attributes['id'] = cube_id
+        return cube
+
+
+class DistributionOptions(object):
+    """Options for summarising an analysis's values as distributions, from its config section.
+
+    distributions: accumulate a histogram and quantile sketch of the values.
+    raw_values: also save every individual value (default True).
+    histogram_bins: min,max,number of bins of the histogram; log spaced if histogram_log.
+    sketch_accuracy: relative accuracy of quantiles from the sketch.
+    """
+    def __init__(self, enabled=False, raw_values=True, histogram_bins=(0.1, 1e5, 60),
+                 histogram_log=True, sketch_accuracy=0.01):
+        self.enabled = enabled
+        self.raw_values = raw_values
+        self.histogram_bins = histogram_bins
+        self.histogram_log = histogram_log
+        self.sketch_accuracy = sketch_accuracy
+
+    @classmethod
+    def from_config(cls, config):
+        options = cls()
+        if 'distributions' in config:
+            options.enabled = config['distributions'] == 'True'
+        if 'raw_values' in config:
+            options.raw_values = config['raw_values'] == 'True'
+        if 'histogram_bins' in config:
+            start, stop, num = config['histogram_bins'].split(',')
+            options.histogram_bins = (float(start), float(stop), int(num))
+        if 'histogram_log' in config:
+            options.histogram_log = config['histogram_log'] == 'True'
+        if 'sketch_accuracy' in config:
+            options.sketch_accuracy = float(config['sketch_accuracy'])
+        return options
+
+    def bin_edges(self):
+        start, stop, num = self.histogram_bins
+        if self.histogram_log:
+            return np.logspace(np.log10(start), np.log10(stop), num + 1)
+        return np.linspace(start, stop, num + 1)
+
+    def new_accumulators(self):
+        return FixedBinHistogram(self.bin_edges()), QuantileSketch(self.sketch_accuracy)
+
+
+def distribution_cubes(histogram, sketch, name, units):
+    """Cubes to save for histogram and sketch of values called name, with ids based on name."""
+    return OrderedDict([
+        (name + '_histogram', histogram.to_cube(name + '-histogram', units, name + '_histogram')),
+        (name + '_sketch', sketch.to_cube(name + '-sketch', units, name + '_sketch')),
+    ])
+
+
+def merge_distribution_files(filenames, output_filename):
+    """Merge the histograms and sketches in the results files filenames into output_filename.
+
+    Reads one file at a time, so uses memory independent of the number of files. The
+    histograms and sketches in the files are matched by id. Quantiles of each merged sketch
+    are saved alongside it.
+    """
+    import iris
+    merged = OrderedDict()
+    for filename in filenames:
+        constraint = iris.AttributeConstraint(distribution=lambda distribution: True)
+        for cube in iris.load(filename, constraint):
+            kind = {'histogram': FixedBinHistogram, 'sketch': QuantileSketch}[
+                cube.attributes['distribution']]
+            accumulator = kind.from_cube(cube)
+            cube_id = cube.attributes['id']
+            if cube_id in merged:
+                merged[cube_id][1].merge(accumulator)
+            else:
+                merged[cube_id] = (cube, accumulator)
+
+    cubes = iris.cube.CubeList()
+    for cube_id, (archetype, accumulator) in merged.items():
+        name = archetype.name()
+        if isinstance(accumulator, FixedBinHistogram):
+            cubes.append(accumulator.to_cube(name, archetype.coord('bin_lower_edge').units,
+                                             cube_id))
+        else:
+            units = archetype.attributes['values_units']
+            cubes.append(accumulator.to_cube(name, units, cube_id))
+            cubes.append(accumulator.quantiles_cube(name.replace('-sketch', '-quantiles'),
+                                                    units, cube_id.replace('_sketch', '_quantiles')))
+    if cubes:
+        iris.save(cubes, output_filename)
+    return cubes
@@ -0,0 +1,279 @@
+"""Read UM fieldsfiles and dumps directly, through an index of their lookup table.
+
+A UM file (UMDP F3) starts with a fixed length header giving the position of the lookup
+table, which has one 64 word entry per field: 45 integers (STASH code, level, times, packing,
+data position...) followed by 19 reals (level values, grid, missing data indicator...).
+FieldsFileIndex reads just the lookup table, so fields can be found without decoding any data,
+and memory maps the file, so that only the records asked for are read. iris cubes are made
+from the lookup entries of the wanted fields only, with their data read from the memory map
+when it is first used. iris is only imported to make cubes, so the index can be used without it.
+"""
+import os
+
+import numpy as np
+
+FIXED_HEADER_WORDS = 256
+LOOKUP_INTS = 45
+LOOKUP_REALS = 19
+
+# Positions in the fixed header, as 0-based word indices (UMDP F3 numbers from 1).
+FH_LOOKUP_START = 149
+FH_LOOKUP_DIM1 = 150
+FH_LOOKUP_DIM2 = 151
+FH_DATA_START = 159
+# Values of the first word of UM files: version 20 files, or 15 for some older files.
+DATASET_VERSIONS = (15, 20)
+
+# Positions of integer lookup entries, as 0-based indices.
+LBYR, LBMON, LBDAT, LBHR, LBMIN, LBSEC = 0, 1, 2, 3, 4, 5
+LBLREC = 14
+LBROW = 17
+LBNPT = 18
+LBPACK = 20
+LBEGIN = 28
+LBNREC = 29
+LBLEV = 32
+LBUSER1 = 38
+LBUSER4 = 41
+# Positions of real lookup entries, as 0-based indices into the reals.
+BDY = 14
+BDX = 16
+BMDI = 17
+
+# LBUSER1: type of the field's data.
+DATA_TYPES = {1: 'f8', 2: 'i8', 3: 'i8'}
+
+
+def file_byteorder(filename):
+    """'>' or '<' for a big or little endian UM file, or None if it does not look like one."""
+    with open(filename, 'rb') as f:
+        first_word = f.read(8)
+    if len(first_word) < 8:
+        return None
+    for byteorder in '><':
+        if np.frombuffer(first_word, byteorder + 'i8')[0] in DATASET_VERSIONS:
+            return byteorder
+    return None
+
+
+def is_fieldsfile(filename):
+    return file_byteorder(filename) is not None
+
+
+def _lazy_data(proxy):
+    """Deferred array of proxy's data, the way the installed version of iris defers data."""
+    try:
+        from iris._lazy_data import as_lazy_data
+    except ImportError:
+        # iris 1.x defers data with biggus.
+        import biggus
+        return biggus.NumpyArrayAdapter(proxy)
+    return as_lazy_data(proxy)
+
+
+class FieldDataProxy(object):
+    """Array-like stand in for the data of one field of a FieldsFileIndex, read when indexed."""
+    def __init__(self, index, field_index):
+        self.index = index
+        self.field_index = field_index
+        ints = index.ints[field_index]
+        self.shape = (int(ints[LBROW]), int(ints[LBNPT]))
+        self.dtype = index.field_dtype(field_index).newbyteorder('=')
+        self.ndim = 2
+
+    def __getitem__(self, keys):
+        return self.index.read_field(self.field_index)[keys]
+
+
+class FieldsFileIndex(object):
+    """Index of the fields in a UM file, from its lookup table.
+
+    ints and reals are the (nfields, 45) and (nfields, 19) integer and real lookup entries of
+    the fields in the file, in file order. Unused entries at the end of the table are dropped.
+    offsets are the byte offsets of each field's data.
+    """
+    def __init__(self, filename, byteorder, ints, reals, offsets):
+        self.filename = filename
+        self.byteorder = byteorder
+        self.ints = ints
+        self.reals = reals
+        self.offsets = offsets
+        self._mmap = None
+
+    @classmethod
+    def from_file(cls, filename):
+        """Read the index from the lookup table of the UM file filename."""
+        byteorder = file_byteorder(filename)
+        if byteorder is None:
+            raise Exception('Not a UM fieldsfile: {}'.format(filename))
+        word = np.dtype(byteorder + 'i8')
+        with open(filename, 'rb') as f:
+            header = np.fromfile(f, word, FIXED_HEADER_WORDS)
+            entry_len = header[FH_LOOKUP_DIM1]
+            nentries = header[FH_LOOKUP_DIM2]
+            f.seek((header[FH_LOOKUP_START] - 1) * word.itemsize)
+            lookup = np.fromfile(f, word, entry_len * nentries).reshape(nentries, entry_len)
+
+        # Unused entries have LBYR -99; they are only at the end of the table.
+        used = lookup[:, LBYR] != -99
+        lookup = lookup[used]
+        ints = lookup[:, :LOOKUP_INTS]
+        reals = lookup[:, LOOKUP_INTS:LOOKUP_INTS + LOOKUP_REALS].view(byteorder + 'f8')
+
+        if len(ints) and (ints[:, LBEGIN] > 0).all():
+            offsets = ints[:, LBEGIN] * 8
+        else:
+            # Older files (and some dumps) leave LBEGIN unset: the data is contiguous from the
+            # start of the data section, each field taking LBNREC (or LBLREC) words.
+            lengths = np.where(ints[:, LBNREC] > 0, ints[:, LBNREC], ints[:, LBLREC])
+            offsets = (header[FH_DATA_START] - 1 + np.concatenate([[0], np.cumsum(lengths)[:-1]])) * 8
+        return cls(filename, byteorder, ints.astype(np.int64), reals.astype(np.float64),
+                   offsets.astype(np.int64))
+
+    @staticmethod
+    def index_filename(filename):
+        return filename + '.index.npz'
+
+    @classmethod
+    def open(cls, filename, persist=False):
+        """Index of filename, read from a saved index next to it if that is up to date.
+
+        If persist, the index is saved next to the file after reading it from the file.
+        """
+        index_filename = cls.index_filename(filename)
+        identity = np.array([os.path.getsize(filename), os.path.getmtime(filename)])
+        if os.path.exists(index_filename):
+            saved = np.load(index_filename)
+            if np.array_equal(saved['identity'], identity):
+                return cls(filename, str(saved['byteorder']), saved['ints'], saved['reals'],
+                           saved['offsets'])
+
+        index = cls.from_file(filename)
+        if persist:
+            # Write then rename, so an interrupted write never leaves a partial index.
+            tmp_filename = index_filename + '.tmp'
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, identity=identity, byteorder=index.byteorder, ints=index.ints,
+                         reals=index.reals, offsets=index.offsets)
+            os.rename(tmp_filename, index_filename)
+        return index
+
+    def __len__(self):
+        return len(self.ints)
+
+    @property
+    def stash_codes(self):
+        """(section, item) of each field."""
+        lbuser4 = self.ints[:, LBUSER4]
+        return [(int(code // 1000), int(code % 1000)) for code in lbuser4]
+
+    def select(self, section, item, lblev=None):
+        """Indices of the fields with STASH (section, item) (and level lblev), in file order."""
+        selected = self.ints[:, LBUSER4] == section * 1000 + item
+        if lblev is not None:
+            selected &= self.ints[:, LBLEV] == lblev
+        return np.nonzero(selected)[0]
+
+    def _memmap(self):
+        if self._mmap is None:
+            self._mmap = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        return self._mmap
+
+    def data_ranges(self, stash_codes):
+        """(offset, nbytes) of the data of the fields with the STASH codes stash_codes.
+
+        In file order, with ranges that follow on from each other joined up.
+        """
+        wanted = set(tuple(code) for code in stash_codes)
+        indices = [index for index, code in enumerate(self.stash_codes) if code in wanted]
+        ranges = []
+        for index in sorted(indices, key=lambda index: self.offsets[index]):
+            ints = self.ints[index]
+            offset = int(self.offsets[index])
+            nbytes = int(ints[LBNREC] if ints[LBNREC] > 0 else ints[LBLREC]) * 8
+            if ranges and sum(ranges[-1]) == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + nbytes)
+            else:
+                ranges.append((offset, nbytes))
+        return ranges
+
+    def field_dtype(self, index):
+        """Type of the data of field index in the file, or None if read_field cannot read it.
+
+        Only unpacked (LBPACK 0) and 32 bit packed (LBPACK 2) fields on a full grid can be
+        read: not WGDOS packed ones, nor ones compressed by a land/sea mask or written in
+        another number format (non-zero LBPACK N2 or N3).
+        """
+        ints = self.ints[index]
+        if ints[LBPACK] // 10 % 100:
+            return None
+        packing = ints[LBPACK] % 10
+        if packing == 0 and ints[LBUSER1] in DATA_TYPES:
+            return np.dtype(self.byteorder + DATA_TYPES[ints[LBUSER1]])
+        if packing == 2:
+            return np.dtype(self.byteorder + 'f4')
+        return None
+
+    def read_field(self, index):
+        """Data of field index as a 2D array, masked where it is missing.
+
+        Only fields with a field_dtype can be read; others need load_cubes.
+        """
+        ints = self.ints[index]
+        dtype = self.field_dtype(index)
+        if dtype is None:
+            raise Exception('Cannot read field {} of {} with packing {}: use load_cubes'
+                            .format(index, self.filename, ints[LBPACK]))
+        shape = (ints[LBROW], ints[LBNPT])
+        # A view of the mapped file: only this field's pages are read, when converted below.
+        raw = np.ndarray(shape, dtype=dtype, buffer=self._memmap(), offset=self.offsets[index])
+        data = raw.astype(dtype.newbyteorder('='))
+        if ints[LBUSER1] == 3:
+            return data.astype(bool)
+        if data.dtype.kind == 'f':
+            return np.ma.masked_values(data, self.reals[index, BMDI], copy=False, shrink=True)
+        return data
+
+    def native_readable(self, index):
+        """Whether field index can be made into a cube from its lookup entry alone.
+
+        Fields whose data read_field cannot read, or whose lookup entry leaves out the grid
+        spacing (which iris then takes from the file's header), need iris's own reader.
+        """
+        reals = self.reals[index]
+        return (self.field_dtype(index) is not None and
+                self.ints[index, LBUSER1] != 3 and
+                all(reals[i] not in (0, reals[BMDI]) for i in (BDX, BDY)))
+
+    def pp_fields(self, indices):
+        """iris PPFields of the fields indices, made from their lookup entries, with their data
+        deferred: it is read from the memory map, at the index's offsets, when first used.
+        """
+        import iris
+        for index in indices:
+            header = (tuple(int(i) for i in self.ints[index]) +
+                      tuple(float(r) for r in self.reals[index]))
+            field = iris.fileformats.pp.make_pp_field(header)
+            field.data = _lazy_data(FieldDataProxy(self, index))
+            yield field
+
+    def load_cubes(self, stash_codes):
+        """iris cubes of the fields with the STASH (section, item) codes in stash_codes.
+
+        The cubes are made from the index's lookup entries of the wanted fields only, so the
+        others are never turned into fields or cubes, and their data are never read. If any
+        wanted field cannot be read that way (see native_readable), the wanted fields are
+        made by iris from the file's headers instead, still without making cubes of the others.
+        """
+        import iris
+        wanted = set(tuple(code) for code in stash_codes)
+        indices = [index for index, code in enumerate(self.stash_codes) if code in wanted]
+        if not indices:
+            return iris.cube.CubeList()
+        if all(self.native_readable(index) for index in indices):
+            fields = self.pp_fields(indices)
+        else:
+            fields = (field for field in iris.fileformats.um.um_to_pp(self.filename)
+                      if (field.stash.section, field.stash.item) in wanted)
+        pairs = iris.fileformats.pp.load_pairs_from_fields(fields)
+        return iris.cube.CubeList(cube for cube, _ in pairs).merge()
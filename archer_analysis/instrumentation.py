@@ -0,0 +1,154 @@
+"""Wall time, CPU time, peak memory and I/O of the stages of an analysis."""
+import time
+import resource
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+def rss_mb():
+    """(current, high water mark) resident memory of this process in MB.
+
+    From /proc/self/status; where that is not available, the current RSS is not known (0) and
+    the high water mark is ru_maxrss (in kB on Linux), the peak over the process's lifetime.
+    """
+    try:
+        values = {}
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':')
+                    values[key] = int(value.split()[0]) / 1024.
+        return values['VmRSS'], values['VmHWM']
+    except (IOError, KeyError, ValueError):
+        return 0., resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def reset_peak_rss():
+    """Reset this process's resident memory high water mark to its current RSS, if possible.
+
+    Returns whether it was reset (needs Linux 4.0 or later).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def io_bytes():
+    """(bytes read, bytes written) by this process so far, or (0, 0) if not available.
+
+    Uses rchar/wchar from /proc/self/io, which count reads served from the page cache too.
+    """
+    try:
+        counters = {}
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+        return counters['rchar'], counters['wchar']
+    except (IOError, KeyError, ValueError):
+        return 0, 0
+
+
+class Timings(object):
+    """Totals of named, possibly nested, spans.
+
+    A span entered more than once (e.g. in a loop) is added to the same total. Nested spans
+    are named after their parents, e.g. 'run/label_blobs'.
+    peak_rss_mb is the most resident memory the process used while in the span (over all the
+    times it was entered), not counting any peak from before it was entered, e.g. from an
+    earlier job in the same pool worker. Where the high water mark cannot be reset, it is the
+    larger of the RSS at the start and end of the span.
+    """
+    def __init__(self):
+        self.spans = OrderedDict()
+        self._stack = []
+        # Peak RSS so far of each span in _stack, from before any reset by a nested span.
+        self._peaks = []
+
+    def _rss_start(self):
+        current, hwm = rss_mb()
+        # The high water mark is about to be reset: keep what it was for the enclosing spans.
+        self._peaks = [max(peak, hwm) for peak in self._peaks]
+        reset = reset_peak_rss()
+        self._peaks.append(current)
+        return reset
+
+    def _rss_end(self, reset):
+        current, hwm = rss_mb()
+        peak = max(self._peaks.pop(), hwm if reset else current)
+        self._peaks = [max(enclosing, peak) for enclosing in self._peaks]
+        return peak
+
+    @contextmanager
+    def span(self, name):
+        self._stack.append(name)
+        full_name = '/'.join(self._stack)
+        rss_reset = self._rss_start()
+        read_start, write_start = io_bytes()
+        wall_start = time.time()
+        cpu_start = time.clock()
+        try:
+            yield
+        finally:
+            read_end, write_end = io_bytes()
+            totals = self.spans.setdefault(full_name, OrderedDict([
+                ('count', 0), ('wall_s', 0.), ('cpu_s', 0.),
+                ('read_bytes', 0), ('write_bytes', 0), ('peak_rss_mb', 0.)]))
+            totals['count'] += 1
+            totals['wall_s'] += time.time() - wall_start
+            totals['cpu_s'] += time.clock() - cpu_start
+            totals['read_bytes'] += read_end - read_start
+            totals['write_bytes'] += write_end - write_start
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], self._rss_end(rss_reset))
+            self._stack.pop()
+
+    def records(self, **fields):
+        """One dict per span, with fields (e.g. analysis and filename) added to each."""
+        records = []
+        for name, totals in self.spans.items():
+            record = OrderedDict(fields)
+            record['span'] = name
+            record.update(totals)
+            records.append(record)
+        return records
+
+
+def summarise_timings(records, num_slowest=10):
+    """Lines of a table of the total time per analysis, and of the slowest jobs.
+
+    records are as returned by Timings.records(analysis=..., filename=...).
+    """
+    # Only top level spans, so nested spans are not counted twice.
+    records = [r for r in records if '/' not in r['span']]
+    by_analysis = OrderedDict()
+    by_job = OrderedDict()
+    for record in records:
+        for totals, key in [(by_analysis, record['analysis']),
+                            (by_job, (record['analysis'], record['filename']))]:
+            total = totals.setdefault(key, {'wall_s': 0., 'cpu_s': 0., 'peak_rss_mb': 0.,
+                                            'read_bytes': 0, 'write_bytes': 0})
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+            total['read_bytes'] += record['read_bytes']
+            total['write_bytes'] += record['write_bytes']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+
+    row = '{:<50} {:>10.2f} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f}'
+    header = '{:<50} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        '', 'wall (s)', 'cpu (s)', 'RSS (MB)', 'read (MB)', 'write (MB)')
+
+    def table_row(name, total):
+        return row.format(name, total['wall_s'], total['cpu_s'], total['peak_rss_mb'],
+                          total['read_bytes'] / 1e6, total['write_bytes'] / 1e6)
+
+    lines = ['Time by analysis:', header]
+    for analysis, total in sorted(by_analysis.items(), key=lambda item: -item[1]['wall_s']):
+        lines.append(table_row(analysis, total))
+    lines.extend(['Slowest jobs:', header])
+    slowest = sorted(by_job.items(), key=lambda item: -item[1]['wall_s'])[:num_slowest]
+    for (analysis, filename), total in slowest:
+        lines.append(table_row('{} {}'.format(analysis, filename), total))
+    return lines
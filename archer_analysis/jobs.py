@@ -0,0 +1,411 @@
+"""Run (analyzer, file) jobs, either one after the other or in a process pool."""
+import os
+import Queue
+import traceback
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.queues import SimpleQueue
+
+from analyzers import ANALYZERS
+from cube_cache import CUBE_CACHE
+from prefetch import Prefetcher
+from fieldsfile import FieldsFileIndex, is_fieldsfile
+from shards import claim, release
+
+
+class Job(object):
+    """Everything needed to build and run one analyzer on one file.
+
+    Only holds plain data, so that it can be sent to a worker process.
+    """
+    def __init__(self, analysis, user, suite, expt, data_type, data_dir, results_dir,
+                 filename, config):
+        self.analysis = analysis
+        self.user = user
+        self.suite = suite
+        self.expt = expt
+        self.data_type = data_type
+        self.data_dir = data_dir
+        self.results_dir = results_dir
+        self.filename = filename
+        self.config = config
+        # Jobs that take their input from this job's results.
+        self.children = []
+        # Fields to load instead of the analyzer's own, so that other jobs using the same
+        # file can be served from the cube cache.
+        self.shared_fields = None
+        # When the run is split between shards, the directory for claim files, so that no two
+        # shards run the job at once (see shards.py), and the shard (index, nshards) running it.
+        self.claim_dir = None
+        self.shard = None
+        self.claim_stale_seconds = 0
+
+    def __repr__(self):
+        return 'Job({}, {})'.format(self.analysis, self.filename)
+
+    def make_analyzer(self):
+        Analyzer = ANALYZERS[self.analysis]
+        analyzer = Analyzer(self.user, self.suite, self.expt, self.data_type,
+                            self.data_dir, self.results_dir, self.filename)
+        analyzer.set_config(self.config)
+        if self.shared_fields and analyzer.fields:
+            analyzer.fields = self.shared_fields
+        return analyzer
+
+
+class JobResult(object):
+    def __init__(self, job, status, error=None, timings=()):
+        self.job = job
+        # One of 'analyzed', 'skipped', 'claimed' (by another shard), 'rendered' or 'failed'.
+        self.status = status
+        self.error = error
+        # Timing records of the job's stages, from Analyzer.timing_records.
+        self.timings = timings
+
+
+def analysis_dag(analyses):
+    """Work out which analysis each analysis in analyses takes its input cubes from.
+
+    An analysis depends on another if any of its declared inputs are in the other's declared
+    outputs. Returns a list of (analysis, parent_analysis) pairs in an order where parents
+    always come before their children, keeping the order of analyses where possible.
+    parent_analysis is None for analyses that read their input from file.
+    """
+    parents = {}
+    for analysis in analyses:
+        inputs = set(ANALYZERS[analysis].inputs)
+        providers = [other for other in analyses
+                     if other != analysis and inputs & set(ANALYZERS[other].outputs)]
+        if len(providers) > 1:
+            raise Exception('Analysis {} has inputs from more than one analysis: {}'
+                            .format(analysis, ', '.join(providers)))
+        parents[analysis] = providers[0] if providers else None
+
+    ordered = []
+    while len(ordered) < len(analyses):
+        ready = [a for a in analyses
+                 if a not in ordered and (parents[a] is None or parents[a] in ordered)]
+        if not ready:
+            raise Exception('Analyses have circular dependencies: {}'
+                            .format(', '.join(a for a in analyses if a not in ordered)))
+        ordered.append(ready[0])
+    return [(analysis, parents[analysis]) for analysis in ordered]
+
+
+def _fail_all(job, error, timings=()):
+    results = [JobResult(job, 'failed', error, timings)]
+    for child in job.children:
+        results.extend(_fail_all(child, 'Upstream job {} failed'.format(job)))
+    return results
+
+
+def _claimed_all(job):
+    return [JobResult(j, 'claimed') for j in all_jobs([job])]
+
+
+def claim_filename(job, analyzer):
+    return os.path.join(job.claim_dir, analyzer.output_filename + '.claim')
+
+
+def run_job(job, upstream=None):
+    """Run one job then its children, respecting the .analyzed marker; never raises.
+
+    If upstream is given, its results are used as this job's input instead of loading from file.
+    Children are passed this job's analyzer, so they get its results in memory, unless this job
+    was skipped, in which case they load its saved results as normal.
+    If the job is claimed by another shard, it and its descendants are left to that shard.
+    Returns a list of JobResults for job and all its descendants.
+    """
+    analyzer = None
+    claimed_filename = None
+    try:
+        analyzer = job.make_analyzer()
+        if job.claim_dir and not (analyzer.already_analyzed() and not analyzer.force):
+            claimed_filename = claim_filename(job, analyzer)
+            if not claim(claimed_filename, {'shard': job.shard, 'job': repr(job)},
+                         job.claim_stale_seconds):
+                claimed_filename = None
+                print('{}: claimed by another shard'.format(job))
+                return _claimed_all(job)
+        # Checked after claiming too, in case another shard finished the job just before.
+        if analyzer.already_analyzed() and not analyzer.force:
+            print('{}: analysis already run'.format(job))
+            results = [JobResult(job, 'skipped')]
+            analyzer = None
+        else:
+            print('{}: running'.format(job))
+            if upstream:
+                analyzer.load_from(upstream)
+            else:
+                analyzer.load()
+            analyzer.run()
+            analyzer.save()
+            results = [JobResult(job, 'analyzed', timings=analyzer.timing_records())]
+    except Exception:
+        error = traceback.format_exc()
+        print('{}: FAILED\n{}'.format(job, error))
+        return _fail_all(job, error, analyzer.timing_records() if analyzer else ())
+    finally:
+        # Once the job is saved its manifest stops it being run again, so the claim can go.
+        if claimed_filename:
+            release(claimed_filename)
+
+    for child in job.children:
+        results.extend(run_job(child, analyzer))
+    return results
+
+
+def group_by_file(jobs, share_fields=False):
+    """Group jobs that read the same file, so they can be run in the same process.
+
+    If share_fields (when the cube cache is on), every job in a group is set to load the union
+    of the group's fields, so the file is only read once if the cache can hold it. Groups are
+    ordered by their first job.
+    """
+    groups = OrderedDict()
+    for job in jobs:
+        path = os.path.abspath(os.path.join(job.data_dir, job.filename))
+        groups.setdefault(path, []).append(job)
+
+    if not share_fields:
+        return list(groups.values())
+    for group in groups.values():
+        fields = set()
+        for job in group:
+            fields |= set(ANALYZERS[job.analysis].fields)
+        for job in group:
+            job.shared_fields = tuple(sorted(fields))
+    return list(groups.values())
+
+
+def estimate_job_memory(job, upstream_bytes=0):
+    """Estimated peak memory of a job and its children, which hold their parent's results.
+
+    Estimated from the fields the job loads, which are its group's when they are shared.
+    A child's input is its parent's results, which do not exist yet when the parent has not
+    been run, so it is estimated as if its input were as big as its parent's (upstream_bytes).
+    """
+    analyzer = job.make_analyzer()
+    estimate = analyzer.estimate_memory() or int(upstream_bytes * analyzer.memory_factor)
+    input_bytes = estimate / analyzer.memory_factor
+    return estimate + sum(estimate_job_memory(child, input_bytes) for child in job.children)
+
+
+def all_analyzed(analyzers):
+    """Whether all of analyzers will be skipped, as already analyzed."""
+    return all(analyzer.already_analyzed() and not analyzer.force for analyzer in analyzers)
+
+
+def estimate_group_memory(group):
+    """Estimated peak memory of a group of jobs; 0 if they and their children will all be
+    skipped."""
+    if all_analyzed([job.make_analyzer() for job in all_jobs(group)]):
+        return 0
+    # The jobs in a group are run one after the other.
+    return max(estimate_job_memory(job) for job in group)
+
+
+def prefetch_target(group):
+    """(filename, ranges) to read ahead for group, as for Prefetcher; filename is None if all
+    its jobs will be skipped as already analyzed.
+
+    Only the data of the group's fields is read from a UM file when all its jobs declare their
+    fields; otherwise the whole file.
+    """
+    filename = os.path.join(group[0].data_dir, group[0].filename)
+    analyzers = [job.make_analyzer() for job in group]
+    if all_analyzed(analyzers):
+        return None, None
+    if not all(analyzer.fields for analyzer in analyzers):
+        return filename, None
+    try:
+        if not is_fieldsfile(filename):
+            return filename, None
+        fields = set(field for analyzer in analyzers for field in analyzer.fields)
+        return filename, FieldsFileIndex.open(filename).data_ranges(fields)
+    except Exception:
+        # The job that uses the file will report the error.
+        return filename, None
+
+
+def run_job_group(jobs):
+    """Run a group of jobs that read the same file, sharing its cubes through the cube cache.
+
+    The cache is emptied afterwards: no later group reads the same file, so its cubes would
+    only hold on to memory that the memory budget does not count.
+    """
+    try:
+        return [result for job in jobs for result in run_job(job)]
+    finally:
+        CUBE_CACHE.clear()
+
+
+# Set in each pool worker, to tell the main process which worker is running which group.
+_started_queue = None
+
+
+def _init_worker(started_queue):
+    global _started_queue
+    _started_queue = started_queue
+
+
+def _run_job_group_in_worker(i, group):
+    _started_queue.put((i, os.getpid()))
+    return run_job_group(group)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def _run_on_pool(pool, started_queue, nprocs, groups, max_bytes, prefetcher, poll_seconds=5.):
+    """Run groups on pool, nprocs at a time; if max_bytes > 0, starting a group only if the
+    estimated memory of all running groups stays under max_bytes.
+
+    Groups are started in order, except that one that does not fit can be overtaken by later
+    ones that do. A group is always started if nothing else is running, even if too big.
+    The groups running are checked every poll_seconds: if the worker running one has died
+    (e.g. killed for running out of memory), its jobs are failed rather than waited for.
+    """
+    estimates = [0] * len(groups)
+    if max_bytes:
+        estimates = [estimate_group_memory(group) for group in groups]
+        for group, estimate in zip(groups, estimates):
+            if estimate > max_bytes:
+                print('{}: estimated memory {:.1f} GB is more than the maximum, will run on its '
+                      'own'.format(group[0], estimate / 1e9))
+
+    finished = Queue.Queue()
+    pending = list(range(len(groups)))
+    # The AsyncResult of each group running, and the pid of the worker running it.
+    running = {}
+    pids = {}
+    dead = set()
+    group_results = [None] * len(groups)
+    while pending or running:
+        for i in list(pending):
+            if len(running) >= nprocs:
+                break
+            if (max_bytes and running and
+                    sum(estimates[j] for j in running) + estimates[i] > max_bytes):
+                continue
+            pending.remove(i)
+            running[i] = pool.apply_async(_run_job_group_in_worker, (i, groups[i]),
+                                          callback=lambda results: finished.put(None))
+        prefetcher.set_started(pending[0] if pending else len(groups))
+
+        # With a timeout, so that lost groups are noticed, and so that Ctrl-C is not blocked.
+        try:
+            finished.get(timeout=poll_seconds)
+        except Queue.Empty:
+            pass
+        while not started_queue.empty():
+            i, pid = started_queue.get()
+            pids[i] = pid
+        for i, result in list(running.items()):
+            if result.ready():
+                try:
+                    group_results[i] = result.get()
+                except Exception:
+                    error = traceback.format_exc()
+                    group_results[i] = [r for job in groups[i] for r in _fail_all(job, error)]
+            elif i in pids and not _is_alive(pids[i]):
+                if i not in dead:
+                    # Its results may be on their way: give them until the next check.
+                    dead.add(i)
+                    continue
+                error = 'The worker process running the job died (e.g. out of memory)'
+                print('{}: FAILED\n{}'.format(groups[i][0], error))
+                group_results[i] = [r for job in groups[i] for r in _fail_all(job, error)]
+            else:
+                continue
+            del running[i]
+    return group_results
+
+
+def run_jobs(jobs, nprocs=1, prefetch_depth=0, prefetch_bytes=0, max_memory_bytes=0):
+    """Run independent trees of jobs, using a pool of nprocs worker processes if nprocs > 1.
+
+    Each job is run in the same process as its children and as any other jobs that read the
+    same file. If prefetch_depth > 0, up to that many files (and prefetch_bytes) beyond those
+    being analyzed are read ahead in the background. If max_memory_bytes > 0, jobs are only
+    run concurrently while their estimated memory adds up to less than it.
+    Returns a flat list of JobResults, grouped by file in the order of jobs.
+    """
+    groups = group_by_file(jobs, CUBE_CACHE.max_bytes > 0)
+    if prefetch_depth > 0:
+        filenames, ranges = zip(*[prefetch_target(group) for group in groups]) or ([], [])
+    else:
+        filenames, ranges = [], []
+    prefetcher = Prefetcher(filenames, prefetch_depth, prefetch_bytes, ranges=ranges)
+    if nprocs <= 1 or len(groups) <= 1:
+        if prefetch_depth > 0:
+            prefetcher.start()
+        try:
+            group_results = []
+            for i, group in enumerate(groups):
+                prefetcher.set_started(i + 1)
+                group_results.append(run_job_group(group))
+        finally:
+            prefetcher.stop()
+    else:
+        nprocs = min(nprocs, len(groups))
+        started_queue = SimpleQueue()
+        pool = Pool(nprocs, _init_worker, (started_queue,))
+        # Started after the pool, so that the workers are not forked with it running.
+        if prefetch_depth > 0:
+            prefetcher.start()
+        try:
+            group_results = _run_on_pool(pool, started_queue, nprocs, groups, max_memory_bytes,
+                                         prefetcher)
+        finally:
+            prefetcher.stop()
+            # Every group has finished or been given up on by now. A group whose worker died
+            # is never finished, and close() would wait for it for ever.
+            pool.terminate()
+            pool.join()
+    return [result for results in group_results for result in results]
+
+
+def all_jobs(jobs):
+    """jobs and all their descendants, parents first."""
+    flat = []
+    for job in jobs:
+        flat.append(job)
+        flat.extend(all_jobs(job.children))
+    return flat
+
+
+def render_job(job):
+    """Make a job's figures from its saved results; never raises."""
+    analyzer = None
+    try:
+        analyzer = job.make_analyzer()
+        print('{}: rendering'.format(job))
+        analyzer.render()
+        return JobResult(job, 'rendered', timings=analyzer.timing_records())
+    except Exception:
+        error = traceback.format_exc()
+        print('{}: RENDER FAILED\n{}'.format(job, error))
+        return JobResult(job, 'failed', error, analyzer.timing_records() if analyzer else ())
+
+
+def render_jobs(jobs, nprocs=1):
+    """Render the figures of those jobs that have plots, using a pool of nprocs processes.
+
+    Only reads saved results, so can be run separately from (and after) analysis.
+    Returns a list of JobResults.
+    """
+    jobs = [job for job in jobs if ANALYZERS[job.analysis].has_plots]
+    if nprocs <= 1 or len(jobs) <= 1:
+        return [render_job(job) for job in jobs]
+    pool = Pool(min(nprocs, len(jobs)))
+    try:
+        return pool.map(render_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
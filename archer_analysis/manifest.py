@@ -0,0 +1,49 @@
+"""Manifests recording what each result was computed from, to tell when it is out of date."""
+import os
+import json
+import hashlib
+
+# Config keys that control how an analysis is run, not what it produces.
+IGNORED_CONFIG_KEYS = ['force', 'filename', 'checksum', 'level_chunk', 'incremental',
+                       'native_reader', 'persist_index', 'timeseries']
+
+
+def file_checksum(path, blocksize=2**24):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def file_identity(path, checksum=False):
+    """Size and either mtime or checksum of the file at path.
+
+    With checksum, a file that has been touched or copied without changing is still the same.
+    """
+    identity = {'size': os.path.getsize(path)}
+    if checksum:
+        identity['checksum'] = file_checksum(path)
+    else:
+        identity['mtime'] = os.path.getmtime(path)
+    return identity
+
+
+def config_hash(config):
+    effective_config = dict((k, v) for k, v in config.items() if k not in IGNORED_CONFIG_KEYS)
+    return hashlib.sha1(json.dumps(effective_config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_manifest(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(filename, manifest):
+    # Write then rename, so an interrupted write never leaves a manifest that can be read.
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_filename, filename)
@@ -1,21 +1,26 @@
 import os
+from collections import OrderedDict
 
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import pylab as plt
 import iris
 
 from analyzer import Analyzer
-from utils import get_cube, get_cube_from_attr, count_blobs_mask
+from utils import get_cube, get_cube_from_attr, count_blobs_mask, blob_stats
+from distributions import DistributionOptions, distribution_cubes
 from consts import Re, L, cp, g
 
 
 class MassFluxAnalyzer(Analyzer):
     analysis_name = 'mass_flux_analysis'
+    inputs = ('w', 'w_mask', 'qcl_mask', 'cloud_mask')
+    distributions = DistributionOptions()
+
+    def set_config(self, config):
+        super(MassFluxAnalyzer, self).set_config(config)
+        self.distributions = DistributionOptions.from_config(config)
 
     def run_analysis(self):
-        cubes = self.cubes
+        cubes = self.cube_index
 
         w = get_cube_from_attr(cubes, 'id', 'w')
 	w_mask_cube = get_cube_from_attr(cubes, 'id', 'w_mask')
@@ -26,26 +31,58 @@ class MassFluxAnalyzer(Analyzer):
 	blob_cube.rename('cloud_blobs')
 	blob_cube.units = ''
 
-	blob_cube_data = np.zeros_like(blob_cube.data)
-	mass_fluxes = []
+	blob_cube_data = np.zeros(blob_cube.shape, dtype=np.int32)
+	stats = OrderedDict((name, []) for name in ['time_index', 'mass_flux', 'area', 'max_w',
+	                                           'centroid_y', 'centroid_x'])
+	if self.distributions.enabled:
+	    histogram, sketch = self.distributions.new_accumulators()
 	for time_index in range(cloud_mask_cube.data.shape[0]):
 	    w_ss = w[time_index].data
 	    cloud_mask_ss = cloud_mask_cube[time_index].data.astype(bool)
-	    max_blob_index, blobs = count_blobs_mask(cloud_mask_ss, True)
+	    with self.span('label_blobs'):
+		max_blob_index, blobs = count_blobs_mask(cloud_mask_ss, True)
 	    blob_cube_data[time_index] = blobs
 
-	    for i in range(1, max_blob_index + 1):
-		mask = (blobs == i)
-		mass_flux = w_ss[mask].sum()
-		mass_fluxes.append(mass_flux)
+	    # Reduce over all blobs in one pass, rather than masking each blob in turn.
+	    with self.span('blob_stats'):
+		area, mass_flux, max_w, centroid_y, centroid_x = blob_stats(blobs, max_blob_index, w_ss)
+	    if self.distributions.enabled:
+		histogram.add(mass_flux)
+		sketch.add(mass_flux)
+	    if not self.distributions.raw_values:
+		continue
+	    stats['time_index'].append(np.repeat(time_index, max_blob_index))
+	    stats['mass_flux'].append(mass_flux)
+	    stats['area'].append(area)
+	    stats['max_w'].append(max_w)
+	    stats['centroid_y'].append(centroid_y)
+	    stats['centroid_x'].append(centroid_x)
 
 	blob_cube.data = blob_cube_data
 	self.results['blobs'] = blob_cube
 
-	values = iris.coords.DimCoord(range(len(mass_fluxes)), long_name='values')
-	mass_flux_cube = iris.cube.Cube(mass_fluxes, 
+	if self.distributions.enabled:
+	    self.results.update(distribution_cubes(histogram, sketch, 'mass_flux', 'kg s-1'))
+	if self.distributions.raw_values:
+	    self._store_values(stats, w.units)
+
+    def _store_values(self, stats, w_units):
+        """Store every blob's stats as flat cubes of values."""
+	stats = OrderedDict((name, np.concatenate(stat)) for name, stat in stats.items())
+	values = iris.coords.DimCoord(range(len(stats['mass_flux'])), long_name='values')
+	mass_flux_cube = iris.cube.Cube(stats['mass_flux'], 
 		                        long_name='mass-flux', 
 					dim_coords_and_dims=[(values, 0)], 
 					units='kg s-1')
 
 	self.results['mass_flux'] = mass_flux_cube
+
+	units = OrderedDict([('time_index', '1'), ('area', '1'), ('max_w', w_units),
+			     ('centroid_y', '1'), ('centroid_x', '1')])
+	for name, stat_units in units.items():
+	    stat_cube = iris.cube.Cube(stats[name],
+				       long_name='blob-{}'.format(name.replace('_', '-')),
+				       dim_coords_and_dims=[(values.copy(), 0)],
+				       units=stat_units)
+	    stat_cube.attributes['id'] = 'blob_' + name
+	    self.results['blob_' + name] = stat_cube
@@ -6,34 +6,66 @@ import iris
 
 from analyzer import Analyzer
 from utils import get_cube_from_attr, coarse_grain
+from distributions import DistributionOptions, distribution_cubes
 
 
 class MassFluxSpatialScalesAnalyzer(Analyzer):
     analysis_name = 'mass_flux_spatial_scales_analysis'
+    inputs = ('w', 'cloud_mask')
+    block_sizes = None
+    distributions = DistributionOptions()
+
+    def set_config(self, config):
+	super(MassFluxSpatialScalesAnalyzer, self).set_config(config)
+	# Optional comma separated list of block widths (in grid cells); default is all that fit.
+	if 'block_sizes' in config:
+	    self.block_sizes = [int(s) for s in config['block_sizes'].split(',')]
+	self.distributions = DistributionOptions.from_config(config)
 
     def run_analysis(self):
-        cubes = self.cubes
+        cubes = self.cube_index
 
         w = get_cube_from_attr(cubes, 'id', 'w')
 	cloud_mask_cube = get_cube_from_attr(cubes, 'id', 'cloud_mask')
 
+	ntimes = cloud_mask_cube.shape[0]
 	mass_flux = OrderedDict()
-	for time_index in range(cloud_mask_cube.data.shape[0]):
+	accumulators = OrderedDict()
+	for time_index in range(ntimes):
 	    w_ss = w[time_index].data
 	    cloud_mask_ss = cloud_mask_cube[time_index].data.astype(bool)
-	    coarse_data = coarse_grain(w_ss, cloud_mask_ss)
+	    with self.span('coarse_grain'):
+		coarse_data = coarse_grain(w_ss, cloud_mask_ss, self.block_sizes)
 	    for n, coarse_datum in coarse_data:
+		if self.distributions.enabled:
+		    if n not in accumulators:
+			accumulators[n] = self.distributions.new_accumulators()
+		    for accumulator in accumulators[n]:
+			accumulator.add(coarse_datum)
+		if not self.distributions.raw_values:
+		    continue
 		if n not in mass_flux:
-		    mass_flux[n] = []
-		else:
-		    mass_flux[n] = np.append(mass_flux[n], coarse_datum.flatten())
-	
+		    # Each scale's size is fixed, so allocate all time steps up front.
+		    mass_flux[n] = np.zeros((ntimes,) + coarse_datum.shape)
+		mass_flux[n][time_index] = coarse_datum
+
+	time = w.coord('time')
+	lat = w.coord('grid_latitude')
+	lon = w.coord('grid_longitude')
 	for key, mass_fluxes in mass_flux.items():
-	    values = iris.coords.DimCoord(range(len(mass_fluxes)), long_name='values')
+	    # Coords for the coarse grid are at the centre of each block.
+	    coarse_lat = lat.copy(lat.points.reshape(mass_fluxes.shape[1], -1).mean(axis=1))
+	    coarse_lon = lon.copy(lon.points.reshape(mass_fluxes.shape[2], -1).mean(axis=1))
 	    name = 'spatial-mass-flux-{}'.format(key)
 	    mass_flux_cube = iris.cube.Cube(mass_fluxes, 
 					    long_name=name, 
-					    dim_coords_and_dims=[(values, 0)], 
+					    dim_coords_and_dims=[(time.copy(), 0),
+								 (coarse_lat, 1),
+								 (coarse_lon, 2)],
 					    units='kg s-1')
 	    mass_flux_cube.attributes['id'] = name
 	    self.results[name] = mass_flux_cube
+
+	for key, (histogram, sketch) in accumulators.items():
+	    self.results.update(distribution_cubes(histogram, sketch,
+						   'spatial_mass_flux_{}'.format(key), 'kg s-1'))
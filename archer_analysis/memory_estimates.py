@@ -0,0 +1,56 @@
+"""Estimate the size of fields in a file from its metadata, without reading their data."""
+import numpy as np
+
+from fieldsfile import FieldsFileIndex, is_fieldsfile, LBPACK, LBROW, LBNPT
+
+
+def netcdf_field_shapes(filename, fields):
+    """(shape, itemsize) of each variable of a netCDF file converted from one of STASH fields.
+
+    Returns None if the netCDF4 module is not available.
+    """
+    try:
+        import netCDF4
+    except ImportError:
+        return None
+    # iris records the STASH code of converted UM fields in this attribute.
+    wanted = set('m01s{:02d}i{:03d}'.format(section, item) for section, item in fields)
+    shapes = []
+    dataset = netCDF4.Dataset(filename)
+    try:
+        for variable in dataset.variables.values():
+            if getattr(variable, 'um_stash_source', None) in wanted:
+                shapes.append((variable.shape, variable.dtype.itemsize))
+    finally:
+        dataset.close()
+    return shapes
+
+
+def fieldsfile_field_shapes(filename, fields):
+    """(shape, itemsize) of each of STASH fields in a UM file, with shape (records, rows, cols)."""
+    index = FieldsFileIndex.open(filename)
+    shapes = []
+    for section, item in fields:
+        indices = index.select(section, item)
+        if not len(indices):
+            continue
+        first = index.ints[indices[0]]
+        # Packed fields are unpacked to 32 bit floats, unpacked ones are kept as 64 bit.
+        itemsize = 8 if first[LBPACK] % 10 == 0 else 4
+        shapes.append(((len(indices), first[LBROW], first[LBNPT]), itemsize))
+    return shapes
+
+
+def field_shapes(filename, fields):
+    """(shape, itemsize) of each of STASH fields in filename, or None if it cannot be told."""
+    if is_fieldsfile(filename):
+        return fieldsfile_field_shapes(filename, fields)
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic[:3] == b'CDF' or magic == b'\x89HDF':
+        return netcdf_field_shapes(filename, fields)
+    return None
+
+
+def shapes_nbytes(shapes):
+    return sum(int(np.prod(shape)) * itemsize for shape, itemsize in shapes)
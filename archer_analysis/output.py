@@ -0,0 +1,112 @@
+"""How analysis results are written to netCDF: compression, chunking and data types."""
+import os
+import tempfile
+
+import numpy as np
+import iris
+
+
+def narrowest_int_dtype(data):
+    """Smallest signed integer type that can hold all the values of integer or bool data."""
+    if data.size == 0:
+        return np.dtype(np.int8)
+    min_value, max_value = int(data.min()), int(data.max())
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def astype_chunked(data, dtype, tmp_dir=None, chunk_bytes=2**28):
+    """data converted to dtype.
+
+    Memory mapped data (e.g. from RestartDumpAnalyzer's level_chunk mode) is converted into a
+    new temporary memory mapped file in tmp_dir, chunk_bytes at a time along its first axis,
+    so that it is never all in memory at once.
+    """
+    if not isinstance(data, np.memmap) or not data.ndim:
+        return data.astype(dtype)
+    converted = np.memmap(tempfile.TemporaryFile(dir=tmp_dir), dtype=dtype, mode='w+',
+                          shape=data.shape)
+    step = max(1, chunk_bytes // max(1, data[0].nbytes))
+    for start in range(0, len(data), step):
+        converted[start:start + step] = data[start:start + step]
+    return converted
+
+
+class OutputOptions(object):
+    """Options for writing an analyzer's results, read from its config section as output_<option>.
+
+    zlib, complevel, shuffle: netCDF4 compression.
+    chunk_time: chunk each variable one time step at a time, for reading a time step quickly.
+    float32: write float64 data as float32.
+    narrow_ints: write integer and bool data in the narrowest signed integer type that holds it.
+    """
+    def __init__(self, zlib=False, complevel=4, shuffle=True, chunk_time=False,
+                 float32=False, narrow_ints=False):
+        self.zlib = zlib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.chunk_time = chunk_time
+        self.float32 = float32
+        self.narrow_ints = narrow_ints
+
+    @classmethod
+    def from_config(cls, config):
+        options = cls()
+        for key in ['zlib', 'shuffle', 'chunk_time', 'float32', 'narrow_ints']:
+            if 'output_' + key in config:
+                setattr(options, key, config['output_' + key] == 'True')
+        if 'output_complevel' in config:
+            options.complevel = int(config['output_complevel'])
+        return options
+
+    def is_default(self):
+        return not (self.zlib or self.chunk_time or self.float32 or self.narrow_ints)
+
+    def output_dtype(self, cube):
+        """Type to write cube's data as, or None to leave it as it is."""
+        dtype = cube.dtype
+        if self.float32 and dtype == np.float64:
+            return np.dtype(np.float32)
+        if self.narrow_ints and (dtype.kind in 'iu' or dtype == np.bool_):
+            narrow_dtype = narrowest_int_dtype(cube.data)
+            if narrow_dtype != dtype:
+                return narrow_dtype
+        return None
+
+    def prepare(self, cube, tmp_dir=None):
+        """cube, or a copy of it with its data converted to the output type.
+
+        The converted data is held in memory, unless the data is memory mapped (see
+        astype_chunked).
+        """
+        dtype = self.output_dtype(cube)
+        if dtype is None:
+            return cube
+        return cube.copy(data=astype_chunked(cube.data, dtype, tmp_dir))
+
+    def write_kwargs(self, cube):
+        """Keyword arguments for iris.fileformats.netcdf.Saver.write."""
+        kwargs = {}
+        if self.zlib:
+            kwargs.update(zlib=True, complevel=self.complevel, shuffle=self.shuffle)
+        if self.chunk_time and cube.ndim and cube.coords('time', dim_coords=True):
+            chunksizes = list(cube.shape)
+            chunksizes[cube.coord_dims('time')[0]] = 1
+            kwargs['chunksizes'] = tuple(chunksizes)
+        return kwargs
+
+
+def save_cubes(cubes, filename, options):
+    """Save cubes to the netCDF file filename using options, an OutputOptions."""
+    if options.is_default():
+        iris.save(cubes, filename)
+        return
+
+    with iris.fileformats.netcdf.Saver(filename, 'NETCDF4') as saver:
+        for cube in cubes:
+            saver.write(options.prepare(cube, os.path.dirname(os.path.abspath(filename))),
+                        **options.write_kwargs(cube))
+        saver.update_global_attributes(Conventions=iris.fileformats.netcdf.CF_CONVENTIONS_VERSION)
@@ -0,0 +1,92 @@
+"""Read input files ahead of their analysis, so that reading overlaps with computing."""
+import os
+import threading
+
+
+class Prefetcher(object):
+    """Reads files in a background thread, ahead of their use, into the OS page cache.
+
+    The files are used in the order of filenames; the user calls set_started(n) as the first n
+    are used. Up to depth files after the ones started are read ahead, as long as they add up
+    to at most max_bytes (0 for no limit; a file bigger than max_bytes is not read ahead).
+    A filename of None is not read (e.g. nothing will be done with it). If ranges is given,
+    ranges[i] is a list of the (offset, nbytes) of filenames[i] to read, or None to read all
+    of it.
+    Only raw bytes are read, in a thread, so loading and analysis are unchanged: they just find
+    the file already in memory.
+    """
+    def __init__(self, filenames, depth=1, max_bytes=0, blocksize=2**24, ranges=None):
+        self.filenames = list(filenames)
+        self.ranges = list(ranges) if ranges is not None else [None] * len(self.filenames)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.blocksize = blocksize
+        self.started = 0
+        # Bytes read ahead, for each file that has not been started yet.
+        self.read_bytes = {}
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def set_started(self, started):
+        with self._condition:
+            self.started = max(self.started, started)
+            for i in list(self.read_bytes):
+                if i < self.started:
+                    del self.read_bytes[i]
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _can_read(self, i, nbytes):
+        if i >= self.started + self.depth:
+            return False
+        if self.max_bytes and sum(self.read_bytes.values()) + nbytes > self.max_bytes:
+            return False
+        return True
+
+    def _run(self):
+        for i, (filename, ranges) in enumerate(zip(self.filenames, self.ranges)):
+            if filename is None:
+                continue
+            try:
+                if ranges is None:
+                    ranges = [(0, os.path.getsize(filename))]
+            except OSError:
+                continue
+            nbytes = sum(length for _, length in ranges)
+            if self.max_bytes and nbytes > self.max_bytes:
+                continue
+            with self._condition:
+                while not self._stopped and i >= self.started and not self._can_read(i, nbytes):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                if i < self.started:
+                    # Already being used: too late to help.
+                    continue
+                self.read_bytes[i] = nbytes
+            self._read(filename, ranges)
+
+    def _read(self, filename, ranges):
+        try:
+            with open(filename, 'rb') as f:
+                for offset, nbytes in ranges:
+                    f.seek(offset)
+                    while not self._stopped and nbytes > 0:
+                        block = f.read(min(self.blocksize, nbytes))
+                        if not block:
+                            break
+                        nbytes -= len(block)
+        except IOError:
+            # The job that uses the file will report the error.
+            pass
@@ -1,23 +1,24 @@
 import os
 
-import matplotlib
-matplotlib.use('Agg')
-import pylab as plt
 import iris
 
 from analyzer import Analyzer
-from utils import get_cube
+from utils import get_cube, get_cube_from_attr, mass_weighted_vertical_integrals
 from consts import Re, L, cp, g
 
 
 class ProfileAnalyzer(Analyzer):
     analysis_name = 'profile_analysis'
+    fields = ((0, 2), (0, 3), (0, 4), (0, 253), (53, 185), (53, 186))
+    has_plots = True
+    # 2: results are tagged with an id attribute, which plot looks them up by.
+    version = 2
 
-    def _plot_uv(self):
+    def _plot_uv(self, plt, results):
         name = self.name
-        u_profile = self.results['u_profile']
-        v_profile = self.results['v_profile']
-        u_heights = self.u_heights
+        u_profile = get_cube_from_attr(results, 'id', 'u_profile')
+        v_profile = get_cube_from_attr(results, 'id', 'v_profile')
+        u_heights = u_profile.coord('level_height').points
         plt.figure(name + '_uv_profile')
         plt.clf()
         plt.title(name + '_uv_profile')
@@ -31,10 +32,10 @@ class ProfileAnalyzer(Analyzer):
         plt.legend()
         plt.savefig(os.path.join(self.results_dir, name + '_uv_profile.png'))
 
-    def _plot_momentum_flux(self):
+    def _plot_momentum_flux(self, plt, results):
         name = self.name
-        u_mom_flux_ts = self.u_mom_flux_ts
-        v_mom_flux_ts = self.v_mom_flux_ts
+        u_mom_flux_ts = get_cube_from_attr(results, 'id', 'u_mom_flux_ts')
+        v_mom_flux_ts = get_cube_from_attr(results, 'id', 'v_mom_flux_ts')
         z = u_mom_flux_ts.coord('level_height').points
 
         plt.figure(name + '_momentum_flux_profile')
@@ -49,7 +50,7 @@ class ProfileAnalyzer(Analyzer):
         plt.savefig(os.path.join(self.results_dir, name + '_momentum_flux_profile.png'))
 
     def run_analysis(self):
-        cubes = self.cubes
+        cubes = self.cube_index
 
         u = get_cube(cubes, 0, 2)
         v = get_cube(cubes, 0, 3)
@@ -57,6 +58,8 @@ class ProfileAnalyzer(Analyzer):
         v_profile = v.collapsed(['time', 'grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
         self.u_heights = u.coord('level_height').points
 
+        u_profile.attributes['id'] = 'u_profile'
+        v_profile.attributes['id'] = 'v_profile'
         self.results['u_profile'] = u_profile
         self.results['v_profile'] = v_profile
 
@@ -82,10 +85,29 @@ class ProfileAnalyzer(Analyzer):
         start_time = u_inc_ts.coord('time').points[0]
         self.times = u_inc_ts.coord('time').points - start_time
 
+        self.u_mom_flux_ts.attributes['id'] = 'u_mom_flux_ts'
+        self.v_mom_flux_ts.attributes['id'] = 'v_mom_flux_ts'
         self.results['u_mom_flux_ts'] = self.u_mom_flux_ts
         self.results['v_mom_flux_ts'] = self.v_mom_flux_ts
 
-    def save_analysis(self):
-        self._plot_uv()
-        self._plot_momentum_flux()
-        plt.close('all')
+        # Column integrals: the kernel integrates over the first dim, so put height first.
+        u_mom_flux_col, v_mom_flux_col = mass_weighted_vertical_integrals(
+            rho_ts.data.T, [u_inc_ts.data.T, v_inc_ts.data.T], dz) / delta_t
+        self.results['u_mom_flux_col_ts'] = self._column_cube(u_inc_ts, u_mom_flux_col,
+                                                              'u_mom_flux_col_ts')
+        self.results['v_mom_flux_col_ts'] = self._column_cube(v_inc_ts, v_mom_flux_col,
+                                                              'v_mom_flux_col_ts')
+
+    def _column_cube(self, archetype_ts, data, name):
+        """Time series cube of column integrated data, using archetype_ts's (time, level) coords."""
+        cube = archetype_ts[:, 0].copy(data=data)
+        for coord in ['model_level_number', 'level_height', 'sigma']:
+            if cube.coords(coord):
+                cube.remove_coord(coord)
+        cube.rename(name)
+        cube.units = 'kg m-1 s-2'
+        return cube
+
+    def plot(self, plt, results):
+        self._plot_uv(plt, results)
+        self._plot_momentum_flux(plt, results)
@@ -1,7 +1,11 @@
+import os
+import tempfile
+
 import numpy as np
 import iris
 
-from utils import get_cube
+from utils import get_cube, mass_weighted_vertical_integrals
+from memory_estimates import field_shapes
 
 from analyzer import Analyzer
 from consts import Re, L, cp, g
@@ -9,11 +13,33 @@ from consts import Re, L, cp, g
 
 class RestartDumpAnalyzer(Analyzer):
     analysis_name = 'restart_dump_analysis'
+    fields = ((0, 4), (0, 10), (0, 12), (0, 253), (0, 254), (0, 255), (0, 272), (0, 273),
+              (0, 389), (0, 391), (0, 392), (0, 393), (0, 394), (0, 395))
+
+    # Number of rho levels of each field to hold in memory at once; 0 for all of them.
+    level_chunk = 0
+    # The MSE terms are each the size of a 3D field.
+    memory_factor = 3.
+
+    def set_config(self, config):
+        super(RestartDumpAnalyzer, self).set_config(config)
+        if 'level_chunk' in config:
+            self.level_chunk = int(config['level_chunk'])
+
+    def estimate_memory(self):
+        if not self.level_chunk or not os.path.exists(self.filename):
+            return super(RestartDumpAnalyzer, self).estimate_memory()
+        shapes = field_shapes(self.filename, self.fields)
+        if not shapes:
+            return super(RestartDumpAnalyzer, self).estimate_memory()
+        # Only level_chunk (+ 1 theta) levels of each field are held at once.
+        nbytes = sum(int(np.prod(shape[1:])) * min(shape[0], self.level_chunk + 1) * itemsize
+                     for shape, itemsize in shapes)
+        return int(nbytes * self.memory_factor)
 
     def run_analysis(self):
         """Get useful cubes from self.dump, perform sanity chacks and calc MSE, TCW."""
-        dump = self.cubes
-        self.rho = get_cube(dump, 0, 253) / Re ** 2
+        dump = self.cube_index
         self.rho_d = get_cube(dump, 0, 389)
 
         self.th = get_cube(dump, 0, 4)
@@ -34,17 +60,114 @@ class RestartDumpAnalyzer(Analyzer):
         self.qvars = [self.q, self.qcl, self.qcf, self.qrain, self.qgraup]
         self.mvars = [self.m, self.mcl, self.mcf, self.mrain, self.mgraup]
 
-        self._sanity_check_water_species(self.qvars, self.mvars)
-        self._sanity_check_wv_density(self.rho, self.rho_d, self.q, self.m)
+        if self.level_chunk:
+            self._run_analysis_chunked(get_cube(dump, 0, 253))
+            return
+
+        self.rho = get_cube(dump, 0, 253) / Re ** 2
+
+        with self.span('sanity_checks'):
+            self._sanity_check_water_species(self.qvars, self.mvars)
+            self._sanity_check_wv_density(self.rho, self.rho_d, self.q, self.m)
+
+        with self.span('tcw'):
+            self._calc_tcw(self.rho, self.qvars)
+        with self.span('mse'):
+            self._calc_mse(self.rho, self.th, self.ep, self.q)
 
-        self._calc_tcw(self.rho, self.qvars)
-        self._calc_mse(self.rho, self.th, self.ep, self.q)
+    def _run_analysis_chunked(self, rho_Re2):
+        """Same as run_analysis, but holding only self.level_chunk levels of each field at once.
+
+        rho_Re2 is the (lazy) cube of rho * Re^2. Gives identical numbers to run_analysis.
+        The sanity check maxima, MSE profiles and column integrals are accumulated block by
+        block, and the 3D MSE fields are written block by block to temporary files in
+        results_dir, from where they are saved.
+        """
+        nlev = rho_Re2.shape[0]
+        z = self.th.coord('level_height').points
+        dz = z[1:] - z[:-1]
+        qvar_dz = self._theta_level_dz(rho_Re2, self.qvars)
+        rho_heights = rho_Re2.coord('level_height').points
+
+        species_max_diffs = [0.0] * len(self.qvars)
+        wv_density_max_diff = 0
+        var_cols = None
+        profiles = dict((name, []) for name in ['MSE', 'MSE_T', 'MSE_Q', 'MSE_Z'])
+        mse_fields = {}
+
+        for start in range(0, nlev, self.level_chunk):
+            end = min(start + self.level_chunk, nlev)
+            # Fields on theta levels need one more level than fields on rho levels.
+            theta_levels = slice(start, end + 1)
+            rho = rho_Re2[start:end].data / Re ** 2
+            th = self.th[theta_levels].data
+            ep = self.ep[start:end].data
+            qvars = [qv[theta_levels].data for qv in self.qvars]
+            mvars = [mv[theta_levels].data for mv in self.mvars]
+            q = qvars[0]
+            m = mvars[0]
+
+            # Each theta level is checked once: the top one only in the last block.
+            checked = slice(0, end - start + (1 if end == nlev else 0))
+            msum = np.zeros_like(mvars[0][checked])
+            for mv in mvars:
+                msum += mv[checked]
+            for i, (qv, mv) in enumerate(zip(qvars, mvars)):
+                diff = np.abs((mv[checked] / (1 + msum)) - qv[checked])
+                species_max_diffs[i] = max(species_max_diffs[i], diff.max())
+
+            q_rho = (q[:-1, :, :] + q[1:, :, :]) / 2
+            m_rho = (m[:-1, :, :] + m[1:, :, :]) / 2
+            rho_d = self.rho_d[start:end].data
+            wv_density_max_diff = max(wv_density_max_diff, np.abs(rho_d * m_rho - rho * q_rho).max())
+
+            with self.span('tcw'):
+                var_cols = mass_weighted_vertical_integrals(rho, qvars, qvar_dz[start:end],
+                                                            from_surface=(start == 0), out=var_cols)
+
+            Lv_rho = rho_heights[start:end, None, None]
+            e_t = rho * (th[:-1, :, :] + th[1:, :, :]) / 2 * ep * cp
+            e_q = rho * (q[:-1, :, :] + q[1:, :, :]) / 2 * L
+            e_z = rho * g * Lv_rho
+            mse = (e_t + e_q + e_z)
+
+            for name, field in [('MSE', mse), ('MSE_T', e_t), ('MSE_Q', e_q), ('MSE_Z', e_z)]:
+                if name not in mse_fields:
+                    mse_fields[name] = self._disk_array((nlev,) + field.shape[1:], field.dtype)
+                mse_fields[name][start:end] = field
+                profiles[name].append(field.mean(axis=(1, 2)))
+
+        self.species_max_diffs = species_max_diffs
+        for qv, max_diff in zip(self.qvars, species_max_diffs):
+            self._print_species_diff(qv.name(), max_diff)
+        self.wv_density_max_diff = wv_density_max_diff
+        print('max diff rho_d * m, rho * q: {}'.format(wv_density_max_diff))
+
+        self._store_tcw(self.qvars, var_cols)
+
+        self.results['MSE'] = self._create_cube(rho_Re2, mse_fields['MSE'], 'Moist Static Energy', 'J')
+        self.results['MSE_T'] = self._create_cube(rho_Re2, mse_fields['MSE_T'], 'Moist Static Energy (T term)', 'J')
+        self.results['MSE_Q'] = self._create_cube(rho_Re2, mse_fields['MSE_Q'], 'Moist Static Energy (Q term)', 'J')
+        self.results['MSE_Z'] = self._create_cube(rho_Re2, mse_fields['MSE_Z'], 'Moist Static Energy (Z term)', 'J')
+
+        self.mse_profile = np.concatenate(profiles['MSE'])
+        self.e_t_profile = np.concatenate(profiles['MSE_T'])
+        self.e_q_profile = np.concatenate(profiles['MSE_Q'])
+        self.e_z_profile = np.concatenate(profiles['MSE_Z'])
+        self._summarise_mse(dz)
+
+    def _disk_array(self, shape, dtype):
+        """Array backed by an anonymous temporary file in results_dir, rather than by memory."""
+        if not os.path.exists(self.results_dir):
+            os.makedirs(self.results_dir)
+        return np.memmap(tempfile.TemporaryFile(dir=self.results_dir), dtype=dtype,
+                         mode='w+', shape=shape)
 
     def _create_cube(self, archetype, data, name, units):
-        cube = archetype.copy()
+        # copy(data=...): don't copy archetype's data only to replace it.
+        cube = archetype.copy(data=data)
         cube.rename(name)
         cube.units = units
-        cube.data = data
         return cube
 
     def _calc_mse(self, rho, th, ep, q):
@@ -74,73 +197,77 @@ class RestartDumpAnalyzer(Analyzer):
         self.e_z_profile = self.e_z.mean(axis=(1, 2))
 
         self.mse_profile = self.mse.mean(axis=(1, 2))
+        self._summarise_mse(dz)
+        return self.mse
+
+    def _summarise_mse(self, dz):
         self.total_mse = (self.mse_profile * dz).sum()
         print('MSE [GJ m^-2] = {0:.5f}'.format(self.total_mse / 1e9))
         print('  E(T) [GJ m^-2] = {0:.5f}'.format((self.e_t_profile * dz).sum() / 1e9))
         print('  E(q) [GJ m^-2] = {0:.5f}'.format((self.e_q_profile * dz).sum() / 1e9))
         print('  E(z) [GJ m^-2] = {0:.5f}'.format((self.e_z_profile * dz).sum() / 1e9))
-        return self.mse
 
-    def _calc_mwvi(self, rho, var):
-        """Calculate Mass Weighted Vertical Integral
+    def _theta_level_dz(self, rho, qvars):
+        """Check qvars are all on theta levels, halfway between rho levels, and return their spacing."""
+        dz = None
+        for var in qvars:
+            cube_heights = var.coord('level_height').points
+            rho_heights = rho.coord('level_height').points
 
-        Must be passed two iris cubes with ndim=3
-        var must be on theta-level, and rho-level mast be halfway between theta-level.
+            if len(cube_heights) != len(rho_heights) + 1:
+                raise Exception('Cube {} not on theta level'.format(var.name()))
 
-        Calculates Integ(rho * var, 0, TOA, dz)
-        """
-        # Remember: for a 3D UM cube, height will be the first coord: e.g. var[0] selects first height.
-        assert isinstance(rho, iris.cube.Cube)
-        assert isinstance(var, iris.cube.Cube)
-        assert rho.ndim == 3
-        assert var.ndim == 3
-
-        cube_heights = var.coord('level_height').points
-        rho_heights = rho.coord('level_height').points
-
-        if len(cube_heights) != len(rho_heights) + 1:
-            raise Exception('Cube {} not on theta level'.format(var.name()))
-
-        cube_heights_on_rho = (cube_heights[:-1] + cube_heights[1:]) / 2
-        isclose = np.isclose(cube_heights_on_rho, rho_heights)
-        if not isclose.all():
-            raise Exception('Interpolation of var heights failed')
-
-        # Work out dz, turn into 3d field to be multiplied by data.
-        dz = cube_heights[1:] - cube_heights[:-1]
-        dz3d = dz.repeat(var.shape[1] * var.shape[2]) \
-                 .reshape(var.shape[0] - 1, var.shape[1], var.shape[2])
-        # dz4d = np.tile(dz3d, (var.shape[0], 1, 1, 1))  # pylint: disable=no-member
-
-        # Work out variable on rho grid, perform integral.
-        var_on_rho_grid_data = (var.data[:-1] + var.data[1:]) / 2
-        # Assume bottom rho level value equal to bottom theta level value
-        # cf:
-        # https://code.metoffice.gov.uk/trac/um/browser/main/branches/dev/chrissmith/
-        # vn10.5_ium_base/src/atmosphere/energy_correction/
-        # vert_eng_massq-vrtemq1b.F90?rev=24919#L297
-        # N.B. has no effect on outcome for data that I have analysed so far:
-        # np.isclose(var.data[:, 0], var.data[:, 1]).all() == True
-        # Therefore adding and averaging is the same as just taking one of them.
-        var_on_rho_grid_data[0] = var.data[0]
-        varXrho = var_on_rho_grid_data * rho.data
-        var_col = (dz3d * varXrho).sum(axis=0)
+            cube_heights_on_rho = (cube_heights[:-1] + cube_heights[1:]) / 2
+            isclose = np.isclose(cube_heights_on_rho, rho_heights)
+            if not isclose.all():
+                raise Exception('Interpolation of var heights failed')
+
+            var_dz = cube_heights[1:] - cube_heights[:-1]
+            if dz is not None and not (var_dz == dz).all():
+                raise Exception('Cube {} not on same theta levels'.format(var.name()))
+            dz = var_dz
+        return dz
 
+    def _mwvi_cube(self, var, var_col):
         # Stuff results into a lovingly crafted cube.
         # Get cube with correct shape (2D horizontal slice).
-        new_cube = var.slices_over('model_level_number').next().copy()
-        new_cube.data = var_col
+        new_cube = var.slices_over('model_level_number').next().copy(data=var_col)
         new_cube.rename('Mass weighted vertical integral of {}'.format(var.name()))
         new_cube.units = 'kg m-2'
         return new_cube
 
     def _calc_tcw(self, rho, qvars):
-        """Calculates Total Column Water from all the specific water species."""
-        self.mwvi_vars = []
+        """Calculates Total Column Water from all the specific water species.
+
+        Integrates the mass weighted vertical integral, Integ(rho * var, 0, TOA, dz), of all
+        species at once. Must be passed iris cubes with ndim=3; qvars must be on theta-levels,
+        and rho-levels must be halfway between theta-levels.
+        """
+        # Remember: for a 3D UM cube, height will be the first coord: e.g. var[0] selects first height.
+        assert isinstance(rho, iris.cube.Cube)
+        assert rho.ndim == 3
         for qv in qvars:
-            mwvi_qv = self._calc_mwvi(rho, qv)
+            assert isinstance(qv, iris.cube.Cube)
+            assert qv.ndim == 3
+
+        dz = self._theta_level_dz(rho, qvars)
+        var_cols = mass_weighted_vertical_integrals(rho.data, [qv.data for qv in qvars], dz)
+        return self._store_tcw(qvars, var_cols)
+
+    def _store_tcw(self, qvars, var_cols):
+        self.mwvi_vars = []
+        for qv, var_col in zip(qvars, var_cols):
+            mwvi_qv = self._mwvi_cube(qv, var_col)
             self.results[mwvi_qv.name()] = mwvi_qv
             self.mwvi_vars.append((qv.name(), mwvi_qv))
+
+        tcw_cube = qvars[0].slices_over('model_level_number').next().copy(data=var_cols.sum(axis=0))
+        tcw_cube.rename('Total column water')
+        tcw_cube.units = 'kg m-2'
+        self.results[tcw_cube.name()] = tcw_cube
+        return self._summarise_tcw()
+
+    def _summarise_tcw(self):
         self.tcw = np.sum([v[1].data.mean() for v in self.mwvi_vars])
         print('Total col water (kg m-2/mm): {}'.format(self.tcw))
         return self.tcw
@@ -151,15 +278,21 @@ class RestartDumpAnalyzer(Analyzer):
         for mv in mvars:
             msum += mv.data
 
+        self.species_max_diffs = []
         for qv, mv in zip(qvars, mvars):
-            print(qv.name())
             diff = np.abs((mv.data / (1 + msum)) - qv.data)
-            print('Max diff: {}'.format(diff.max()))
-            if diff.max() > 1e-15:
-                print('MAX DIFF TOO LARGE')
+            self.species_max_diffs.append(diff.max())
+            self._print_species_diff(qv.name(), diff.max())
+
+    def _print_species_diff(self, name, max_diff):
+        print(name)
+        print('Max diff: {}'.format(max_diff))
+        if max_diff > 1e-15:
+            print('MAX DIFF TOO LARGE')
 
     def _sanity_check_wv_density(self, rho, rho_d, q, m):
         q_rho = (q.data[:-1, :, :] + q.data[1:, :, :]) / 2
         m_rho = (m.data[:-1, :, :] + m.data[1:, :, :]) / 2
 
-        print('max diff rho_d * m, rho * q: {}'.format(np.abs(rho_d.data * m_rho - rho.data * q_rho).max()))
+        self.wv_density_max_diff = np.abs(rho_d.data * m_rho - rho.data * q_rho).max()
+        print('max diff rho_d * m, rho * q: {}'.format(self.wv_density_max_diff))
@@ -1,12 +1,27 @@
 import os
 import sys
 import re
+import json
+import errno
+import argparse
+import traceback
+import datetime as dt
 from glob import glob
+from collections import OrderedDict
+from multiprocessing import Pool
 from configparser import ConfigParser
 
 import iris
 
 from analyzers import ANALYZERS
+from jobs import Job, JobResult, analysis_dag, run_jobs, all_jobs, render_jobs
+from cube_cache import CUBE_CACHE
+from instrumentation import summarise_timings
+from distributions import merge_distribution_files
+from timeseries import concatenate_results
+from fieldsfile import FieldsFileIndex
+from shards import (SHARD_ENV, parse_shard, shard_name, select_shard, shard_log_filename,
+                    merge_shard_logs)
 
 
 def convert_ff2nc_filename(filepath):
@@ -21,7 +36,25 @@ def convert_ff2nc_filename(filepath):
     return os.path.join(dirname, newname)
 
 
-def convert_to_nc(filename, overwrite=False, delete=False):
+def get_stash_codes(filename):
+    """(section, item) STASH code of every field in a fields file, read from its lookup table."""
+    return list(OrderedDict.fromkeys(FieldsFileIndex.from_file(filename).stash_codes))
+
+
+def save_in_stash_batches(filename, converted_filename, batch_size):
+    """Convert a fields file, loading batch_size STASH codes at a time to bound memory use."""
+    stash_codes = get_stash_codes(filename)
+    with iris.fileformats.netcdf.Saver(converted_filename, 'NETCDF4') as saver:
+	for i in range(0, len(stash_codes), batch_size):
+	    batch = set(stash_codes[i:i + batch_size])
+	    constraint = iris.AttributeConstraint(
+		STASH=lambda stash: (stash.section, stash.item) in batch)
+	    for cube in iris.load(filename, constraint):
+		saver.write(cube)
+	saver.update_global_attributes(Conventions=iris.fileformats.netcdf.CF_CONVENTIONS_VERSION)
+
+
+def convert_to_nc(filename, overwrite=False, delete=False, batch_size=0):
     messages = ['archer_analysis convert']
     converted_filename = convert_ff2nc_filename(filename)
 
@@ -38,8 +71,16 @@ def convert_to_nc(filename, overwrite=False, delete=False):
     messages.append('Original filename: {}'.format(filename))
     messages.append('New filename: {}'.format(converted_filename))
 
-    cubes = iris.load(filename)
-    iris.save(cubes, converted_filename)
+    # Write to a temporary file so that a failed conversion is not mistaken for a done one.
+    # It keeps the .nc extension, from which iris.save picks its saver.
+    tmp_filename = converted_filename + '.tmp.nc'
+    if batch_size:
+	messages.append('Converting {} STASH codes at a time'.format(batch_size))
+	save_in_stash_batches(filename, tmp_filename, batch_size)
+    else:
+	cubes = iris.load(filename)
+	iris.save(cubes, tmp_filename)
+    os.rename(tmp_filename, converted_filename)
 
     if delete:
 	print('Delete: {}'.format(filename))
@@ -53,16 +94,48 @@ def convert_to_nc(filename, overwrite=False, delete=False):
     return converted_filename
 
 
+def try_convert_to_nc(args):
+    """Call convert_to_nc(*args), returning the traceback of any error instead of raising."""
+    try:
+	convert_to_nc(*args)
+	return None
+    except Exception:
+	error = traceback.format_exc()
+	print('Could not convert {}\n{}'.format(args[0], error))
+	return error
+
+
+def convert_files(filenames, overwrite=False, delete=False, batch_size=0, nprocs=1):
+    """Convert fields files to netCDF, nprocs at a time.
+
+    Returns a list of (filename, traceback) for each file that could not be converted.
+    """
+    args = [(filename, overwrite, delete, batch_size) for filename in filenames]
+    if nprocs <= 1 or len(filenames) <= 1:
+	errors = [try_convert_to_nc(arg) for arg in args]
+    else:
+	pool = Pool(min(nprocs, len(filenames)))
+	try:
+	    errors = pool.map(try_convert_to_nc, args, chunksize=1)
+	finally:
+	    pool.close()
+	    pool.join()
+    return [(filename, error) for filename, error in zip(filenames, errors) if error]
+
+
 class RunControl(object):
+    # Set by run from the command line; these defaults run every job in one task.
+    shard = None
+    merge_shards = False
+
     def run(self):
 	dataw_dir, datam_dir, user, suite = self.read_env()
 	data_type, expt = self.read_args()
+	self.shard, self.merge_shards = self.read_shard_args()
 	self.dataw_dir = dataw_dir
 	self.datam_dir = datam_dir
 	self.user = user
 	self.suite = suite
-	self.data_type = data_type
-	self.expt = expt
 
 	self.run_analysis(dataw_dir, datam_dir, user, suite, data_type, expt)
 
@@ -78,6 +151,21 @@ class RunControl(object):
 	expt = sys.argv[2]
 	return data_type, expt
 
+    def read_shard_args(self):
+	"""This task's shard as (index, nshards), or None, and whether to merge the shards' logs.
+
+	Given as e.g. --shard 2/8 after the data_type and expt, or in the environment as
+	ANALYSIS_SHARD=2/8, e.g. from the parameter of a cylc job array.
+	"""
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--shard', default=os.getenv(SHARD_ENV))
+	parser.add_argument('--merge-shards', action='store_true')
+	args = parser.parse_args(sys.argv[3:])
+	shard = parse_shard(args.shard) if args.shard else None
+	if shard and args.merge_shards:
+	    raise Exception('Cannot run a shard and merge the shards in the same task')
+	return shard, args.merge_shards
+
     def read_config(self, config_dir):
 	config = ConfigParser()
 	with open(os.path.join(config_dir, 'rose-app-run.conf'), 'r') as f:
@@ -87,80 +175,296 @@ class RunControl(object):
     def run_analysis(self, config_dir, datam_dir, user, suite, data_type, expt):
 	config = self.read_config(config_dir)
 	self.config = config
+	# For tagging the timing and job log records.
+	self.data_type = data_type
+	self.expt = expt
 
 	settings_sec = '{}_settings'.format(data_type)
 	runcontrol_sec = '{}_runcontrol'.format(data_type)
 
-	settings = config[settings_sec]
+	# Every setting has a default, so the section can be left out.
+	settings = config[settings_sec] if config.has_section(settings_sec) else {}
 	runcontrol = config[runcontrol_sec]
 
-	convert = settings['convert_to_nc'] == 'True'
-	overwrite = settings['overwrite'] == 'True'
-	delete = settings['delete'] == 'True'
-
-	if convert:
+	convert = settings.get('convert_to_nc', 'False') == 'True'
+	overwrite = settings.get('overwrite', 'False') == 'True'
+	delete = settings.get('delete', 'False') == 'True'
+	nprocs = int(settings.get('nprocs', '1'))
+	# Figures are made from the saved results, after all analysis is done. render_only
+	# remakes the figures of every job without running any analysis.
+	render = settings.get('render', 'True') == 'True'
+	render_only = settings.get('render_only', 'False') == 'True'
+	render_nprocs = int(settings.get('render_nprocs', str(nprocs)))
+
+	if data_type == 'dataw':
+	    # N.B. config_dir is DATAW *for the current task*.
+	    # Need to work out where the atmos DATAW dir is.
+	    dataw_dir = os.path.join(os.path.dirname(config_dir), expt + '_atmos')
+
+	if convert and not render_only and not self.merge_shards:
 	    if data_type == 'datam':
 		filenames = sorted(glob(os.path.join(datam_dir, 'atmos.???.pp?')))
 	    elif data_type == 'dataw':
-		# N.B. config_dir is DATAW *for the current task*.
-		# Need to work out where the atmos DATAW dir is.
-		dataw_dir = os.path.join(os.path.dirname(config_dir), expt + '_atmos')
 		filenames = sorted(glob(os.path.join(dataw_dir, 'atmos.pp?')))
+	    if self.shard:
+		# The same shard then analyzes the converted file.
+		filenames = select_shard(filenames, self.shard)
 
-	    for filename in filenames:
-		try:
-		    convert_to_nc(filename, overwrite, delete)
-		except:
-		    print('Could not convert {}'.format(filename))
+	    convert_nprocs = int(settings.get('convert_nprocs', str(nprocs)))
+	    batch_size = int(settings.get('convert_batch_size', '0'))
+	    convert_failures = convert_files(filenames, overwrite, delete, batch_size, convert_nprocs)
+	else:
+	    convert_failures = []
+
+	if data_type == 'dataw':
+	    data_dir = dataw_dir
+	    results_dir = config_dir
+	elif data_type == 'datam':
+	    data_dir = datam_dir
+	    results_dir = datam_dir
+	else:
+	    raise Exception('Unknown data_type: {}'.format(data_type))
 
+	analyses = []
 	for ordered_analysis, enabled_str in sorted(runcontrol.items()):
 	    analysis = ordered_analysis[3:]
 	    enabled = enabled_str == 'True'
 	    if not enabled:
 		continue
-	    print('Run analysis: {}'.format(analysis))
 
-	    if config.has_section(analysis):
-		analyzer_config = config[analysis]
-	    else:
+	    if not config.has_section(analysis):
 		raise Exception('NO CONFIG FOR ANALYSIS, SKIPPING')
 
 	    if analysis not in ANALYZERS:
 		raise Exception('COULD NOT FIND ANALYZER: {}'.format(analysis))
-
-	    Analyzer = ANALYZERS[analysis]
-
-	    filename = analyzer_config.pop('filename')
-	    if data_type == 'dataw':
-		print(filename)
-
-		data_dir = dataw_dir
-		results_dir = config_dir
-		analyzer = Analyzer(user, suite, expt, data_type, data_dir, results_dir, filename)
-		analyzer.set_config(analyzer_config)
-		if not analyzer.already_analyzed() or analyzer.force:
-		    analyzer.load()
-		    analyzer.run()
-		    analyzer.save()
+	    analyses.append(analysis)
+
+	# Analyses whose inputs are produced by another analysis are run on each of its output
+	# files, in the same job tree, so that they get its results in memory.
+	# Independent trees (different files, or unrelated analyses) are run concurrently.
+	root_jobs = []
+	jobs_by_analysis = {}
+	for analysis, parent in analysis_dag(analyses):
+	    print('Run analysis: {}'.format(analysis))
+	    analyzer_config = dict(config[analysis].items())
+	    filename = analyzer_config.pop('filename', None)
+
+	    if parent:
+		print('  using results of {}'.format(parent))
+		jobs = []
+		for parent_job in jobs_by_analysis[parent]:
+		    output_filename = parent_job.make_analyzer().output_filename
+		    job = Job(analysis, user, suite, expt, data_type, parent_job.results_dir,
+			      results_dir, output_filename, analyzer_config)
+		    parent_job.children.append(job)
+		    jobs.append(job)
+	    else:
+		if data_type == 'dataw':
+		    print(filename)
+		    filenames = [filename]
 		else:
-		    print('analysis already run')
-	    elif data_type == 'datam':
-		# filename can be a glob.
-		dataw_settings = self.config['datam_settings']
-		filenames = Analyzer.get_files(datam_dir, filename)
-		for actual_filename in filenames:
-		    print(actual_filename)
-		    results_dir = datam_dir
-		    analyzer = Analyzer(user, suite, expt, data_type, datam_dir, results_dir, actual_filename)
-		    analyzer.set_config(analyzer_config)
-		    if not analyzer.already_analyzed() or analyzer.force:
-			analyzer.load()
-			analyzer.run()
-			analyzer.save()
-		    else:
-			print('analysis already run')
+		    # filename can be a glob.
+		    filenames = ANALYZERS[analysis].get_files(datam_dir, filename)
+		jobs = [Job(analysis, user, suite, expt, data_type, data_dir, results_dir,
+			    actual_filename, analyzer_config)
+			for actual_filename in filenames]
+		root_jobs.extend(jobs)
+	    jobs_by_analysis[analysis] = jobs
+
+	timings_filename = os.path.join(results_dir, 'analysis_timings.jsonl')
+	jobs_filename = os.path.join(results_dir, 'analysis_jobs.jsonl')
+	if self.merge_shards:
+	    self.merge_shard_results(timings_filename, jobs_filename, root_jobs)
+	    return
+	if self.shard:
+	    # All the jobs of a file go to the same shard, with their job trees.
+	    selected = set(select_shard([job.filename for job in root_jobs], self.shard))
+	    shard_jobs = [job for job in root_jobs if job.filename in selected]
+	    print('Shard {}: {} of {} jobs'.format(shard_name(self.shard), len(shard_jobs),
+						   len(root_jobs)))
+	    root_jobs = shard_jobs
+	    claim_dir = os.path.join(results_dir, 'analysis_claims')
+	    try:
+		os.makedirs(claim_dir)
+	    except OSError as e:
+		if e.errno != errno.EEXIST:
+		    raise
+	    stale_seconds = float(settings.get('shard_claim_timeout_hours', '0')) * 3600
+	    for job in all_jobs(root_jobs):
+		job.claim_dir = claim_dir
+		job.shard = shard_name(self.shard)
+		job.claim_stale_seconds = stale_seconds
+	    timings_filename = shard_log_filename(timings_filename, self.shard)
+	    jobs_filename = shard_log_filename(jobs_filename, self.shard)
+
+	# Set before run_jobs starts any worker processes, so that they all inherit it.
+	CUBE_CACHE.max_bytes = int(float(settings.get('cache_memory_gb', '0')) * 1e9)
+	if render_only:
+	    job_results = []
+	    to_render = all_jobs(root_jobs)
+	else:
+	    prefetch_depth = int(settings.get('prefetch_depth', '0'))
+	    prefetch_bytes = int(float(settings.get('prefetch_memory_gb', '0')) * 1e9)
+	    max_memory_bytes = int(float(settings.get('max_memory_gb', '0')) * 1e9)
+	    job_results = run_jobs(root_jobs, nprocs, prefetch_depth, prefetch_bytes, max_memory_bytes)
+	    # Skipped jobs' results have not changed, so neither have their figures.
+	    to_render = [r.job for r in job_results if r.status == 'analyzed']
+	reduce_failures = []
+	if not render_only and not self.shard:
+	    # Otherwise left to the merge step, once all the shards have finished.
+	    reduce_failures = (self.reduce_distributions(job_results) +
+			       self.reduce_timeseries(job_results))
+
+	if render or render_only:
+	    render_results = render_jobs(to_render, render_nprocs)
+	else:
+	    render_results = []
+
+	self.write_timings(job_results + render_results, timings_filename)
+	self.write_job_log(job_results, render_results, jobs_filename)
+	self.report(job_results, convert_failures, render_results, reduce_failures=reduce_failures)
+
+    def merge_shard_results(self, timings_filename, jobs_filename, root_jobs):
+	"""Merge the logs of all the shards of a run, reduce its distributions, and report on it."""
+	timings = [json.loads(line) for line in merge_shard_logs(timings_filename)]
+	records = [json.loads(line) for line in merge_shard_logs(jobs_filename)]
+	print('Merged the logs of {} jobs'.format(len(records)))
+
+	# Distributions are reduced over the results of every job of the run, whichever shard ran it.
+	saved = []
+	for job in all_jobs(root_jobs):
+	    analyzer = job.make_analyzer()
+	    if os.path.exists(os.path.join(analyzer.results_dir, analyzer.output_filename)):
+		saved.append(JobResult(job, 'skipped'))
+	saved_jobs = set(repr(r.job) for r in saved)
+
+	# A shard that was run more than once logs a job each time: only its latest record counts,
+	# and a record of it being run counts over one of it being claimed by another shard.
+	latest = OrderedDict()
+	for r in sorted(records, key=lambda r: (r['status'] != 'claimed', r['run_finished'])):
+	    latest[(r['stage'], r['job'])] = r
+	job_results = []
+	render_results = []
+	for (stage, job), r in latest.items():
+	    if stage == 'render':
+		render_results.append(JobResult(job, r['status'], r.get('error')))
+	    elif r['status'] == 'claimed' and job not in saved_jobs:
+		# Only ever claimed by a shard that did not finish it, e.g. because it was killed.
+		job_results.append(JobResult(job, 'failed', 'Claimed, but not run by any shard'))
 	    else:
-		raise Exception('Unknown data_type: {}'.format(data_type))
+		job_results.append(JobResult(job, r['status'], r.get('error')))
+	for job in all_jobs(root_jobs):
+	    if ('analysis', repr(job)) not in latest and repr(job) not in saved_jobs:
+		# e.g. its shard was never run, or was killed before writing its log.
+		job_results.append(JobResult(repr(job), 'failed', 'Not run by any shard'))
+	reduce_failures = self.reduce_distributions(saved) + self.reduce_timeseries(saved)
+	self.report(job_results, render_results=render_results, timings=timings,
+		    reduce_failures=reduce_failures)
+
+    def results_filenames(self, job_results, option):
+	"""Results files of the jobs that did not fail, of each analysis with option = True.
+
+	Returns an OrderedDict of (analysis, results_dir): [results filename].
+	"""
+	results_filenames = OrderedDict()
+	for job_result in job_results:
+	    job = job_result.job
+	    if job_result.status == 'failed' or job.config.get(option) != 'True':
+		continue
+	    analyzer = job.make_analyzer()
+	    results_filenames.setdefault((job.analysis, analyzer.results_dir), []).append(
+		os.path.join(analyzer.results_dir, analyzer.output_filename))
+	return results_filenames
+
+    def reduce_distributions(self, job_results):
+	"""Merge the distributions saved by every job of each analysis into one file per analysis.
+
+	Returns a list of (output filename, error) of those that failed.
+	"""
+	failures = []
+	for (analysis, results_dir), filenames in self.results_filenames(job_results,
+									  'distributions').items():
+	    runid = os.path.basename(filenames[0]).split('.')[0]
+	    output_filename = os.path.join(results_dir, '{}.{}.distributions.nc'.format(runid, analysis))
+	    print('Merge distributions: {} files -> {}'.format(len(filenames), output_filename))
+	    try:
+		merge_distribution_files(filenames, output_filename)
+	    except Exception:
+		failures.append((output_filename, traceback.format_exc()))
+	return failures
+
+    def reduce_timeseries(self, job_results):
+	"""Join the results of every job of each analysis along time into one file per analysis.
+
+	Only files new since the last run are read, if the earlier ones have not changed.
+	Returns a list of (output filename, error) of those that failed.
+	"""
+	failures = []
+	for (analysis, results_dir), filenames in self.results_filenames(job_results,
+									  'timeseries').items():
+	    runid = os.path.basename(filenames[0]).split('.')[0]
+	    output_filename = os.path.join(results_dir, '{}.{}.timeseries.nc'.format(runid, analysis))
+	    try:
+		nread = concatenate_results(filenames, output_filename)
+	    except Exception:
+		failures.append((output_filename, traceback.format_exc()))
+		continue
+	    print('Join time series: {} files ({} read) -> {}'.format(len(filenames), nread,
+								     output_filename))
+	return failures
+
+    def write_timings(self, job_results, filename):
+	"""Append the timing records of all jobs to filename as JSON lines, tagged with this run."""
+	run = {'run_finished': dt.datetime.now().isoformat(), 'data_type': self.data_type,
+	       'expt': self.expt}
+	with open(filename, 'a') as f:
+	    for job_result in job_results:
+		for record in job_result.timings:
+		    record = dict(record, status=job_result.status, **run)
+		    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def write_job_log(self, job_results, render_results, filename):
+	"""Append the status of each job and render to filename as JSON lines."""
+	run = {'run_finished': dt.datetime.now().isoformat(), 'data_type': self.data_type,
+	       'expt': self.expt}
+	with open(filename, 'a') as f:
+	    for stage, results in [('analysis', job_results), ('render', render_results)]:
+		for job_result in results:
+		    record = dict(run, stage=stage, job=repr(job_result.job),
+				  status=job_result.status, error=job_result.error)
+		    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def report(self, job_results, convert_failures=(), render_results=(), timings=None,
+	       reduce_failures=()):
+	for filename, error in convert_failures:
+	    print('FAILED TO CONVERT: {}'.format(filename))
+	    print(error)
+	for filename, error in reduce_failures:
+	    print('FAILED TO WRITE: {}'.format(filename))
+	    print(error)
+
+	job_results = list(job_results)
+	render_results = list(render_results)
+	if timings is None:
+	    timings = [record for r in job_results + render_results for record in r.timings]
+	if timings:
+	    for line in summarise_timings(timings):
+		print(line)
+
+	failed = [r for r in job_results if r.status == 'failed']
+	render_failed = [r for r in render_results if r.status == 'failed']
+	for status in ['analyzed', 'skipped', 'claimed', 'failed']:
+	    print('{}: {}'.format(status, len([r for r in job_results if r.status == status])))
+	print('rendered: {}'.format(len(render_results) - len(render_failed)))
+	print('render failed: {}'.format(len(render_failed)))
+	for job_result in failed + render_failed:
+	    print('FAILED: {}'.format(job_result.job))
+	    print(job_result.error)
+	if failed or render_failed or convert_failures or reduce_failures:
+	    raise Exception('{} analysis jobs failed, {} renders failed, {} files could not be converted, '
+			    '{} time series or distributions could not be written'
+			    .format(len(failed), len(render_failed), len(convert_failures),
+				    len(reduce_failures)))
 
 
 if __name__ == '__main__':
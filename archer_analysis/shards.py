@@ -0,0 +1,153 @@
+"""Split the jobs of a run between concurrent tasks (shards), e.g. the members of a cylc job array.
+
+Each shard takes the jobs whose input file hashes to it, so that the split does not depend on
+which other files exist, and every job of a file (and its job tree) is in the same shard.
+Each job is claimed, by atomically creating a claim file, before it is run, so that shards that
+overlap (or a shard restarted while its previous attempt is still running) never run the same
+job at once. Each shard writes its own logs, which merge_shard_logs joins up afterwards.
+"""
+import os
+import re
+import errno
+import glob
+import json
+import time
+import socket
+import zlib
+
+SHARD_ENV = 'ANALYSIS_SHARD'
+
+
+def parse_shard(text):
+    """(index, nshards) from 'i/N', where shards are numbered 0 to N - 1."""
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', text)
+    if not match:
+        raise Exception('Shard must be given as i/N: {}'.format(text))
+    index, nshards = int(match.group(1)), int(match.group(2))
+    if not 0 <= index < nshards:
+        raise Exception('Shard index must be between 0 and {}: {}'.format(nshards - 1, text))
+    return index, nshards
+
+
+def shard_name(shard):
+    return 'shard-{}-of-{}'.format(*shard)
+
+
+def file_shard(filename, nshards):
+    """Shard of filename, from a hash of its name.
+
+    A fieldsfile and the netCDF file converted from it (with .nc added) are in the same shard.
+    """
+    key = os.path.basename(filename)
+    if key.endswith('.nc'):
+        key = key[:-3]
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % nshards
+
+
+def select_shard(filenames, shard):
+    index, nshards = shard
+    return [filename for filename in filenames if file_shard(filename, nshards) == index]
+
+
+def claim(claim_filename, owner, stale_seconds=0):
+    """Atomically create claim_filename, recording owner; False if someone else has claimed it.
+
+    A claim left by a process on this host that has died, or older than stale_seconds (if not
+    0), is taken to be left by a shard that failed, and is taken over.
+    """
+    while True:
+        try:
+            fd = os.open(claim_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not _take_stale(claim_filename, stale_seconds):
+                return False
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(dict(owner, host=socket.gethostname(), pid=os.getpid(),
+                                    claimed=time.time()), sort_keys=True) + '\n')
+        return True
+
+
+def read_claim(claim_filename):
+    """What claim wrote to claim_filename, or {} if it has not been written yet."""
+    try:
+        with open(claim_filename, 'r') as f:
+            return json.loads(f.read() or '{}')
+    except (IOError, ValueError):
+        return {}
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _is_stale(claimed, claim_filename, stale_seconds):
+    if (claimed.get('host') == socket.gethostname() and 'pid' in claimed and
+            not _process_alive(claimed['pid'])):
+        return True
+    return bool(stale_seconds) and time.time() - os.path.getmtime(claim_filename) > stale_seconds
+
+
+def _take_stale(claim_filename, stale_seconds):
+    """Remove claim_filename if it is stale; True if the claim can be tried again."""
+    claimed = read_claim(claim_filename)
+    try:
+        if not _is_stale(claimed, claim_filename, stale_seconds):
+            return False
+    except OSError:
+        # Released in between.
+        return True
+    # Only one of the shards trying to take over the claim can rename it away.
+    stale_filename = '{}.stale.{}.{}'.format(claim_filename, socket.gethostname(), os.getpid())
+    try:
+        os.rename(claim_filename, stale_filename)
+    except OSError:
+        return False
+    if read_claim(stale_filename) != claimed:
+        # Another shard took the claim over first, and this renamed its new claim: put it back.
+        try:
+            os.link(stale_filename, claim_filename)
+        except OSError:
+            pass
+        os.remove(stale_filename)
+        return False
+    os.remove(stale_filename)
+    return True
+
+
+def release(claim_filename):
+    try:
+        os.remove(claim_filename)
+    except OSError:
+        pass
+
+
+def shard_log_filename(filename, shard):
+    """Per shard version of the log filename, e.g. analysis_timings.shard-0-of-4.jsonl."""
+    root, ext = os.path.splitext(filename)
+    return '{}.{}{}'.format(root, shard_name(shard), ext)
+
+
+def merge_shard_logs(filename):
+    """Append the lines of every per shard version of the log filename to it, then remove them.
+
+    Returns the lines merged.
+    """
+    root, ext = os.path.splitext(filename)
+    shard_filenames = sorted(glob.glob('{}.shard-*-of-*{}'.format(root, ext)))
+    lines = []
+    for shard_filename in shard_filenames:
+        with open(shard_filename, 'r') as f:
+            lines.extend(f.readlines())
+    if lines:
+        with open(filename, 'a') as f:
+            f.writelines(lines)
+    for shard_filename in shard_filenames:
+        os.remove(shard_filename)
+    return lines
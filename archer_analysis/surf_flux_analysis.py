@@ -1,26 +1,31 @@
 import os
+import json
 
-import matplotlib
-matplotlib.use('Agg')
 import numpy as np
-import pylab as plt
 import iris
 
 from analyzer import Analyzer
-from utils import get_cube
+from utils import get_cube, get_cube_from_attr
 from consts import L
 
 
 class SurfFluxAnalyzer(Analyzer):
     """Analyze surface fluxes, plot graphs of energy/moisture fluxes."""
     analysis_name = 'surf_flux_analysis'
+    fields = ((3, 217), (3, 234), (4, 203))
+    # Only analyze time steps added since the last run, and append them to its results.
+    incremental = False
+    has_plots = True
+    # 2: results are tagged with an id attribute, which plot looks them up by.
+    version = 2
 
-    def _plot(self):
+    def plot(self, plt, results):
+        """Plot graphs of energy/moisture fluxes."""
         name = self.name
-        precip_ts = self.precip_ts
-        lhf_ts = self.lhf_ts
-        shf_ts = self.shf_ts
-        times = self.times
+        precip_ts = get_cube_from_attr(results, 'id', 'precip_ts')
+        lhf_ts = get_cube_from_attr(results, 'id', 'lhf_ts')
+        shf_ts = get_cube_from_attr(results, 'id', 'shf_ts')
+        times = precip_ts.coord('time').points - precip_ts.coord('time').points[0]
 
         plt.figure(name + '_energy_fluxes')
         plt.clf()
@@ -50,24 +55,104 @@ class SurfFluxAnalyzer(Analyzer):
         plt.xlabel('time (hrs)')
         plt.savefig(os.path.join(self.results_dir, name + '_water_fluxes.png'))
 
+    def set_config(self, config):
+        super(SurfFluxAnalyzer, self).set_config(config)
+        if 'incremental' in config:
+            self.incremental = config['incremental'] == 'True'
+
+    def state_filename(self):
+        return os.path.join(self.results_dir, self.output_filename + '.state')
+
+    def read_state(self):
+        """State of the last incremental run, or None if there is not one to continue from."""
+        if not self.incremental or self.force or not os.path.exists(self.state_filename()):
+            return None
+        if not os.path.exists(os.path.join(self.results_dir, self.output_filename)):
+            return None
+        with open(self.state_filename(), 'r') as f:
+            state = json.load(f)
+        if state.get('version', 1) != self.version:
+            # Made by a different version: start again.
+            return None
+        return state
+
+    def already_analyzed(self):
+        if not self.incremental:
+            return super(SurfFluxAnalyzer, self).already_analyzed()
+        # The input file grows as the model runs: only skip it if it has not changed.
+        state = self.read_state()
+        return (state is not None and
+                state['size'] == os.path.getsize(self.filename) and
+                state['mtime'] == os.path.getmtime(self.filename))
+
     def run_analysis(self):
-        cubes = self.cubes
+        cubes = self.cube_index
 
         precip = get_cube(cubes, 4, 203)
         lhf = get_cube(cubes, 3, 234)
         shf = get_cube(cubes, 3, 217)
 
-        self.precip_ts = precip.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        self.lhf_ts = lhf.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
-        self.shf_ts = shf.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
+        fluxes = [precip, lhf, shf]
+        state = self.read_state()
+        if state:
+            # Slicing is lazy, so only the new time steps are read.
+            fluxes = self._new_times(fluxes, state['last_time'])
+
+        flux_tss = [flux.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
+                    for flux in fluxes]
+        if state:
+            flux_tss = self._append_to_previous([precip, lhf, shf], flux_tss)
+        self.precip_ts, self.lhf_ts, self.shf_ts = flux_tss
+
+        start_time = self.precip_ts.coord('time').points[0]
+        self.times = self.precip_ts.coord('time').points - start_time
+
+        for name, ts in [('precip_ts', self.precip_ts), ('lhf_ts', self.lhf_ts),
+                         ('shf_ts', self.shf_ts)]:
+            ts.attributes['id'] = name
+            self.results[name] = ts
 
-        start_time = precip.coord('time').points[0]
-        self.times = precip.coord('time').points - start_time
+    def _new_times(self, cubes, last_time):
+        """Slices of cubes after last_time, or [] if any cube has nothing new."""
+        new_cubes = []
+        for cube in cubes:
+            times = cube.coord('time').points
+            first_new = np.searchsorted(times, last_time, side='right')
+            if first_new == len(times):
+                return []
+            new_cubes.append(cube[first_new:])
+        return new_cubes
 
-        self.results['precip_ts'] = self.precip_ts
-        self.results['lhf_ts'] = self.lhf_ts
-        self.results['shf_ts'] = self.shf_ts
+    def _append_to_previous(self, cubes, new_tss):
+        """Join the time series saved by the last run for each of cubes with any new_tss."""
+        previous = iris.load(os.path.join(self.results_dir, self.output_filename))
+        tss = []
+        for i, cube in enumerate(cubes):
+            previous_ts = previous.extract(iris.Constraint(cube.name()))[0]
+            # Realise now: the file it comes from is about to be overwritten.
+            previous_ts.data
+            if new_tss:
+                # Loading from netCDF sets var_names that the new time series do not have, and
+                # concatenation needs all the metadata to match.
+                previous_ts.attributes = new_tss[i].attributes
+                previous_ts.var_name = new_tss[i].var_name
+                for coord in previous_ts.coords():
+                    new_coords = new_tss[i].coords(coord.name())
+                    if new_coords:
+                        coord.var_name = new_coords[0].var_name
+                # It may have been saved with a narrower type (see output_float32).
+                previous_ts.data = previous_ts.data.astype(new_tss[i].dtype)
+                tss.append(iris.cube.CubeList([previous_ts, new_tss[i]]).concatenate_cube())
+            else:
+                tss.append(previous_ts)
+        return tss
 
-    def save_analysis(self):
-        """Save all results for surf flux analysis."""
-        self._plot()
+    def save(self):
+        super(SurfFluxAnalyzer, self).save()
+        if self.incremental:
+            state = {'version': self.version,
+                     'last_time': float(self.precip_ts.coord('time').points[-1]),
+                     'size': os.path.getsize(self.filename),
+                     'mtime': os.path.getmtime(self.filename)}
+            with open(self.state_filename(), 'w') as f:
+                json.dump(state, f)
@@ -0,0 +1,207 @@
+"""Generate synthetic UM-like cubes, laid out as the analyzers expect, for testing and benchmarks.
+
+Fields are on a rotated lat/lon grid (grid_latitude, grid_longitude), with model_level_number
+and level_height coords on theta or rho levels, and STASH attributes. The values are
+plausible (e.g. rho decreases with height, water species satisfy q = m / (1 + sum(m))), but
+are not a simulation of anything.
+iris is only imported when cubes are made, so that the heights can be used without it.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from consts import Re
+
+# STASH (section, item): (name, units, levels), where levels is one of:
+# 'theta': nz + 1 theta levels, 'rho': nz rho levels, 'rho+1': nz + 1 rho levels (exner),
+# 'surface': no level dimension.
+FIELDS = OrderedDict([
+    ((0, 2), ('x_wind', 'm s-1', 'rho')),
+    ((0, 3), ('y_wind', 'm s-1', 'rho')),
+    ((0, 4), ('air_potential_temperature', 'K', 'theta')),
+    ((0, 10), ('specific_humidity', '1', 'theta')),
+    ((0, 12), ('mass_fraction_of_cloud_ice_in_air', '1', 'theta')),
+    ((0, 150), ('upward_air_velocity', 'm s-1', 'theta')),
+    ((0, 253), ('density_r_r_level_zero', 'kg m-1', 'rho')),
+    ((0, 254), ('mass_fraction_of_cloud_liquid_water_in_air', '1', 'theta')),
+    ((0, 255), ('dimensionless_exner_function', '1', 'rho+1')),
+    ((0, 272), ('mass_fraction_of_rain_in_air', '1', 'theta')),
+    ((0, 273), ('mass_fraction_of_graupel_in_air', '1', 'theta')),
+    ((0, 389), ('air_density', 'kg m-3', 'rho')),
+    ((0, 391), ('humidity_mixing_ratio', '1', 'theta')),
+    ((0, 392), ('cloud_liquid_water_mixing_ratio', '1', 'theta')),
+    ((0, 393), ('cloud_ice_mixing_ratio', '1', 'theta')),
+    ((0, 394), ('rain_mixing_ratio', '1', 'theta')),
+    ((0, 395), ('graupel_mixing_ratio', '1', 'theta')),
+    ((3, 217), ('surface_upward_sensible_heat_flux', 'W m-2', 'surface')),
+    ((3, 234), ('surface_upward_latent_heat_flux', 'W m-2', 'surface')),
+    ((4, 203), ('stratiform_rainfall_flux', 'kg m-2 s-1', 'surface')),
+    ((53, 185), ('u_wind_increment', 'm s-1', 'rho')),
+    ((53, 186), ('v_wind_increment', 'm s-1', 'rho')),
+])
+
+# Specific (q) and mixing ratio (m) water species items, in matching order.
+Q_ITEMS = [10, 254, 12, 272, 273]
+M_ITEMS = [391, 392, 393, 394, 395]
+
+
+def theta_heights(nz, top=40000.):
+    """nz + 1 theta level heights, stretched to be closer together near the surface."""
+    return top * np.linspace(0, 1, nz + 1) ** 2
+
+
+def rho_heights(nz, top=40000.):
+    z = theta_heights(nz, top)
+    return (z[:-1] + z[1:]) / 2
+
+
+def _level_coords(levels, nz):
+    import iris
+    if levels == 'theta':
+        heights = theta_heights(nz)
+        numbers = np.arange(nz + 1)
+    elif levels == 'rho':
+        heights = rho_heights(nz)
+        numbers = np.arange(1, nz + 1)
+    elif levels == 'rho+1':
+        z = theta_heights(nz)
+        heights = np.concatenate([rho_heights(nz), [z[-1] + (z[-1] - z[-2]) / 2]])
+        numbers = np.arange(1, nz + 2)
+    model_level_number = iris.coords.DimCoord(numbers, standard_name='model_level_number',
+                                              units='1')
+    level_height = iris.coords.AuxCoord(heights, long_name='level_height', units='m')
+    return model_level_number, level_height
+
+
+def _horizontal_coords(ny, nx, dx=0.01):
+    import iris
+    cs = iris.coord_systems.RotatedGeogCS(90., 180.)
+    grid_latitude = iris.coords.DimCoord((np.arange(ny) - ny / 2.) * dx, 'grid_latitude',
+                                         units='degrees', coord_system=cs)
+    grid_longitude = iris.coords.DimCoord(180. + (np.arange(nx) - nx / 2.) * dx, 'grid_longitude',
+                                          units='degrees', coord_system=cs)
+    grid_latitude.guess_bounds()
+    grid_longitude.guess_bounds()
+    return grid_latitude, grid_longitude
+
+
+def _time_coord(ntimes, dt_hours=0.25):
+    import iris
+    return iris.coords.DimCoord(np.arange(ntimes) * dt_hours, standard_name='time',
+                                units='hours since 2000-01-01 00:00:00')
+
+
+def _field_data(section, item, shape, heights, rs):
+    """Plausible values for field (section, item); shape ends (levels, ny, nx) if 3D."""
+    z = heights.reshape((-1, 1, 1)) if heights is not None else 0
+    noise = rs.standard_normal(shape)
+    if (section, item) == (0, 253):
+        return Re ** 2 * 1.2 * np.exp(-z / 8000.) * (1 + 0.001 * noise)
+    elif (section, item) == (0, 389):
+        return 1.2 * np.exp(-z / 8000.) * (1 + 0.001 * noise)
+    elif (section, item) == (0, 4):
+        return 300. + 0.004 * z + 0.1 * noise
+    elif (section, item) == (0, 255):
+        return np.exp(-z / 30000.) * (1 + 0.0001 * noise)
+    elif (section, item) == (0, 150):
+        # Mostly weak, with the occasional strong updraught.
+        return 0.1 * noise + 3. * (rs.uniform(size=shape) > 0.98)
+    elif item in M_ITEMS:
+        scale = 0.015 if item == 391 else 0.0005
+        return scale * np.exp(-z / 3000.) * rs.uniform(size=shape)
+    elif (section, item) == (4, 203):
+        return 1e-4 * np.abs(noise)
+    elif section == 3:
+        return 100. + 20. * noise
+    else:
+        return noise
+
+
+def make_cube(section, item, nz, ny, nx, ntimes=None, rs=None):
+    """Synthetic cube for STASH (section, item); 3D fields have nz (rho) levels.
+
+    If ntimes is None there is no time dimension (as for a restart dump).
+    """
+    import iris
+    from iris.fileformats.pp import STASH
+    if rs is None:
+        rs = np.random.RandomState(section * 1000 + item)
+    name, units, levels = FIELDS[(section, item)]
+    dim_coords = []
+    if ntimes is not None:
+        dim_coords.append(_time_coord(ntimes))
+    heights = None
+    if levels != 'surface':
+        model_level_number, level_height = _level_coords(levels, nz)
+        heights = level_height.points
+        dim_coords.append(model_level_number)
+    dim_coords.extend(_horizontal_coords(ny, nx))
+
+    shape = tuple(len(c.points) for c in dim_coords)
+    data = _field_data(section, item, shape, heights, rs).astype(np.float32)
+    cube = iris.cube.Cube(data, units=units,
+                          dim_coords_and_dims=[(c, i) for i, c in enumerate(dim_coords)])
+    cube.rename(name)
+    if levels != 'surface':
+        cube.add_aux_coord(level_height, len(dim_coords) - 3)
+    cube.attributes['STASH'] = STASH(1, section, item)
+    return cube
+
+
+def make_cubes(stash_codes, nz, ny, nx, ntimes=None, seed=0):
+    """CubeList of synthetic fields, one for each (section, item) in stash_codes.
+
+    The water species are made consistent with each other: each specific field q is
+    calculated from the mixing ratio fields m.
+    """
+    import iris
+    rs = np.random.RandomState(seed)
+    cubes = OrderedDict()
+    stash_codes = list(stash_codes)
+    need_water = [code for code in stash_codes if code[0] == 0 and code[1] in Q_ITEMS]
+    if need_water:
+        for item in M_ITEMS:
+            cubes[(0, item)] = make_cube(0, item, nz, ny, nx, ntimes, rs)
+        msum = sum(cubes[(0, item)].data for item in M_ITEMS)
+        for q_item, m_item in zip(Q_ITEMS, M_ITEMS):
+            q = make_cube(0, q_item, nz, ny, nx, ntimes, rs)
+            q.data = cubes[(0, m_item)].data / (1 + msum)
+            cubes[(0, q_item)] = q
+
+    for code in stash_codes:
+        if code not in cubes:
+            cubes[code] = make_cube(code[0], code[1], nz, ny, nx, ntimes, rs)
+    return iris.cube.CubeList([cubes[code] for code in stash_codes])
+
+
+def make_analyzer_cubes(Analyzer, nz, ny, nx, ntimes):
+    """Cubes with all of Analyzer's declared fields, and any inputs it needs from other analyzers.
+
+    Restart dump fields have no time dimension.
+    """
+    if Analyzer.analysis_name == 'restart_dump_analysis':
+        ntimes = None
+    cubes = make_cubes(Analyzer.fields, nz, ny, nx, ntimes)
+    if Analyzer.inputs:
+        cubes.extend(make_cloud_analysis_results(ny, nx, ntimes))
+    return cubes
+
+
+def make_cloud_analysis_results(ny, nx, ntimes, w_thresh=1., qcl_thresh=0.0001):
+    """Single level cubes with ids as produced by CloudAnalyzer, as used by the mass flux analyzers."""
+    import iris
+    from iris.fileformats.pp import STASH
+    w = make_cube(0, 150, 1, ny, nx, ntimes)[:, 0]
+    qcl = w.copy(data=(np.abs(w.data) * 0.001).astype(np.float32))
+    qcl.rename('mass_fraction_of_cloud_liquid_water_in_air')
+    qcl.attributes['STASH'] = STASH(1, 0, 254)
+    w_mask = w.data > w_thresh
+    qcl_mask = qcl.data > qcl_thresh
+    cubes = iris.cube.CubeList()
+    for cube_id, cube in [('w', w), ('qcl', qcl),
+                          ('w_mask', w.copy(data=w_mask.astype(int))),
+                          ('qcl_mask', w.copy(data=qcl_mask.astype(int))),
+                          ('cloud_mask', w.copy(data=(w_mask & qcl_mask).astype(int)))]:
+        cube.attributes['id'] = cube_id
+        cubes.append(cube)
+    return cubes
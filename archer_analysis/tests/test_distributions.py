@@ -0,0 +1,123 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from distributions import (FixedBinHistogram, QuantileSketch, QUANTILES, distribution_cubes,
+                           merge_distribution_files)
+try:
+    import iris
+except ImportError:
+    iris = None
+
+
+def make_values(seed=0):
+    """Mixed-sign values spanning several orders of magnitude, with some zeros."""
+    rs = np.random.RandomState(seed)
+    values = rs.lognormal(0, 3, size=5000) * rs.choice([-1, 1], size=5000, p=[0.3, 0.7])
+    values[rs.uniform(size=5000) < 0.1] = 0
+    return values
+
+
+def exact_quantile(values, q):
+    """The value at rank q * (n - 1), rounded down, as for np.percentile(..., 'lower')."""
+    return np.sort(values)[int(np.floor(q * (len(values) - 1)))]
+
+
+class TestFixedBinHistogram(unittest.TestCase):
+    def test_merged_chunks_match_whole(self):
+        values = make_values()
+        edges = np.logspace(-2, 2, 21)
+        whole = FixedBinHistogram(edges)
+        whole.add(values)
+        merged = FixedBinHistogram(edges)
+        for chunk in np.array_split(values, 7):
+            histogram = FixedBinHistogram(edges)
+            histogram.add(chunk)
+            merged.merge(histogram)
+        np.testing.assert_array_equal(merged.counts, whole.counts)
+        self.assertEqual(whole.counts.sum(), len(values))
+        self.assertEqual(whole.counts[0], (values < edges[0]).sum())
+        self.assertEqual(whole.counts[-1], (values >= edges[-1]).sum())
+
+    def test_different_edges_not_merged(self):
+        self.assertRaises(Exception, FixedBinHistogram([0, 1]).merge, FixedBinHistogram([0, 2]))
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_quantiles_within_relative_accuracy(self):
+        values = make_values()
+        for relative_accuracy in [0.01, 0.05]:
+            sketch = QuantileSketch(relative_accuracy)
+            sketch.add(values)
+            self.assertEqual(sketch.count, len(values))
+            for q in [0, 0.01, 0.05, 0.2, 0.3, 0.5, 0.75, 0.95, 0.99, 1]:
+                expected = exact_quantile(values, q)
+                self.assertLessEqual(abs(sketch.quantile(q) - expected),
+                                     relative_accuracy * abs(expected) * (1 + 1e-9), q)
+
+    def test_merge_is_order_independent(self):
+        chunks = np.array_split(make_values(), 5)
+        sketches = []
+        for chunk in chunks:
+            sketch = QuantileSketch()
+            sketch.add(chunk)
+            sketches.append(sketch)
+        merged = []
+        for order in [range(5), range(5)[::-1], [2, 0, 4, 1, 3]]:
+            sketch = QuantileSketch()
+            for i in order:
+                sketch.merge(sketches[i])
+            merged.append(sketch)
+        whole = QuantileSketch()
+        whole.add(np.concatenate(chunks))
+        for sketch in merged:
+            self.assertEqual(sketch.positive, whole.positive)
+            self.assertEqual(sketch.negative, whole.negative)
+            self.assertEqual(sketch.zero_count, whole.zero_count)
+            self.assertEqual([sketch.quantile(q) for q in QUANTILES],
+                             [whole.quantile(q) for q in QUANTILES])
+
+    def test_empty(self):
+        self.assertTrue(np.isnan(QuantileSketch().quantile(0.5)))
+
+
+@unittest.skipIf(iris is None, 'needs iris')
+class TestMergeDistributionFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_merged_files_match_whole(self):
+        values = make_values()
+        edges = np.logspace(-2, 2, 21)
+        filenames = []
+        for i, chunk in enumerate(np.array_split(values, 3)):
+            histogram, sketch = FixedBinHistogram(edges), QuantileSketch()
+            histogram.add(chunk)
+            sketch.add(chunk)
+            filename = os.path.join(self.tmp_dir, 'atmos.{:03d}.nc'.format(i))
+            iris.save(list(distribution_cubes(histogram, sketch, 'w', 'm s-1').values()),
+                      filename)
+            filenames.append(filename)
+        output_filename = os.path.join(self.tmp_dir, 'merged.nc')
+        merge_distribution_files(filenames, output_filename)
+
+        histogram, sketch = FixedBinHistogram(edges), QuantileSketch()
+        histogram.add(values)
+        sketch.add(values)
+        cubes = iris.load(output_filename)
+        by_id = dict((cube.attributes['id'], cube) for cube in cubes)
+        np.testing.assert_array_equal(by_id['w_histogram'].data, histogram.counts)
+        np.testing.assert_array_equal(by_id['w_quantiles'].data,
+                                      [sketch.quantile(q) for q in QUANTILES])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fieldsfile
+from fieldsfile import FieldsFileIndex
+try:
+    import iris
+except ImportError:
+    iris = None
+
+
+def write_fieldsfile(filename, byteorder, fields, lbegin=True, nentries=10):
+    """Write a minimal UM fieldsfile of fields, a list of (stash, lblev, hour, data, lbpack).
+
+    Float data is written as 64 bit, or as 32 bit with lbpack 2; integer data as 64 bit.
+    """
+    word = byteorder + 'i8'
+    header = np.zeros(256, word)
+    header[0] = 20
+    header[149] = 257
+    header[150] = 64
+    header[151] = nentries
+    data_start = 256 + 64 * nentries
+    header[159] = data_start + 1
+    lookup = np.zeros((nentries, 64), word)
+    lookup[:, 0] = -99
+    records = []
+    position = data_start
+    for i, (stash, lblev, hour, data, lbpack) in enumerate(fields):
+        ints = lookup[i]
+        ints[0], ints[1], ints[2], ints[3] = 2000, 1, 1, hour
+        # Regular grid (LBCODE), model levels (LBVC).
+        ints[15] = 1
+        ints[25] = 65
+        ints[17], ints[18] = data.shape
+        ints[20] = lbpack
+        ints[32] = lblev
+        ints[38] = 1 if data.dtype.kind == 'f' else 2
+        ints[41] = stash[0] * 1000 + stash[1]
+        if lbpack % 10 == 2:
+            dtype = 'f4'
+        else:
+            dtype = 'f8' if data.dtype.kind == 'f' else 'i8'
+        raw = data.astype(byteorder + dtype).tobytes()
+        raw += b'\0' * (-len(raw) % 8)
+        nwords = len(raw) // 8
+        ints[14] = ints[29] = nwords
+        ints[28] = position if lbegin else 0
+        reals = lookup[i, 45:].view(byteorder + 'f8')
+        reals[14] = reals[16] = 0.01
+        reals[17] = -1e30
+        records.append(raw)
+        position += nwords
+    with open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(lookup.tobytes())
+        f.write(b''.join(records))
+
+
+class TestFieldsFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'atmos.000.pp1')
+        rs = np.random.RandomState(0)
+        self.theta = rs.standard_normal((4, 5))
+        self.theta[0, 0] = -1e30
+        self.ints = np.arange(20).reshape(4, 5)
+        self.packed = rs.standard_normal((3, 3)).astype(np.float32)
+        self.fields = [((0, 4), 1, 0, self.theta, 0),
+                       ((0, 4), 2, 0, self.theta * 2, 0),
+                       ((3, 217), 1, 0, self.ints, 0),
+                       ((0, 10), 1, 0, self.packed, 2),
+                       ((0, 12), 1, 0, self.theta, 1),
+                       ((0, 13), 1, 0, self.theta, 120)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_fields(self):
+        for byteorder in '><':
+            for lbegin in [True, False]:
+                write_fieldsfile(self.filename, byteorder, self.fields, lbegin)
+                self.assertTrue(fieldsfile.is_fieldsfile(self.filename))
+                index = FieldsFileIndex.from_file(self.filename)
+                self.assertEqual(index.byteorder, byteorder)
+                self.assertEqual(len(index), len(self.fields))
+                self.assertEqual(list(index.select(0, 4)), [0, 1])
+                self.assertEqual(list(index.select(0, 4, lblev=2)), [1])
+
+                theta = index.read_field(0)
+                self.assertTrue(theta.mask[0, 0])
+                self.assertEqual(theta.mask.sum(), 1)
+                np.testing.assert_array_equal(theta.filled(-1e30), self.theta)
+                np.testing.assert_array_equal(index.read_field(2), self.ints)
+                packed = index.read_field(3)
+                self.assertEqual(packed.dtype, np.float32)
+                np.testing.assert_array_equal(packed, self.packed)
+
+    def test_unreadable_packings(self):
+        write_fieldsfile(self.filename, '>', self.fields)
+        index = FieldsFileIndex.from_file(self.filename)
+        # WGDOS packed, and land/sea mask compressed.
+        for i in [4, 5]:
+            self.assertIsNone(index.field_dtype(i))
+            self.assertFalse(index.native_readable(i))
+            self.assertRaises(Exception, index.read_field, i)
+        self.assertTrue(index.native_readable(0))
+
+    def test_saved_index(self):
+        write_fieldsfile(self.filename, '<', self.fields)
+        index = FieldsFileIndex.open(self.filename, persist=True)
+        self.assertTrue(os.path.exists(FieldsFileIndex.index_filename(self.filename)))
+        saved = FieldsFileIndex.open(self.filename)
+        np.testing.assert_array_equal(saved.ints, index.ints)
+        np.testing.assert_array_equal(saved.offsets, index.offsets)
+
+    def test_data_ranges(self):
+        write_fieldsfile(self.filename, '>', self.fields)
+        index = FieldsFileIndex.from_file(self.filename)
+        start = int(index.offsets[0])
+        # The two theta fields are next to each other, so are read as one range.
+        self.assertEqual(index.data_ranges([(0, 4)]), [(start, 2 * 20 * 8)])
+        self.assertEqual(index.data_ranges([(3, 217), (0, 12)]),
+                         [(start + 2 * 20 * 8, 20 * 8), (int(index.offsets[4]), 20 * 8)])
+
+    @unittest.skipIf(iris is None, 'needs iris')
+    def test_load_cubes_reads_only_wanted_fields(self):
+        write_fieldsfile(self.filename, '>', self.fields)
+        index = FieldsFileIndex.from_file(self.filename)
+        um_to_pp = iris.fileformats.um.um_to_pp
+
+        def fail(*args, **kwargs):
+            raise Exception('Read the file through iris')
+        iris.fileformats.um.um_to_pp = fail
+        try:
+            cubes = index.load_cubes([(0, 4)])
+        finally:
+            iris.fileformats.um.um_to_pp = um_to_pp
+
+        self.assertEqual(set((cube.attributes['STASH'].section, cube.attributes['STASH'].item)
+                             for cube in cubes), set([(0, 4)]))
+        fields = [field for cube in cubes for field in cube.data.reshape(-1, 4, 5)]
+        self.assertEqual(len(fields), 2)
+        self.assertTrue(any((field == self.theta * 2).all() for field in fields))
+
+    @unittest.skipIf(iris is None, 'needs iris')
+    def test_load_cubes_falls_back_to_iris_for_packed_fields(self):
+        write_fieldsfile(self.filename, '>', self.fields)
+        index = FieldsFileIndex.from_file(self.filename)
+        um_to_pp = iris.fileformats.um.um_to_pp
+        read = []
+
+        def record(filename):
+            read.append(filename)
+            return iter([])
+        iris.fileformats.um.um_to_pp = record
+        try:
+            index.load_cubes([(0, 12)])
+        finally:
+            iris.fileformats.um.um_to_pp = um_to_pp
+        self.assertEqual(read, [self.filename])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import iris
+    import jobs
+    from analyzers import ANALYZERS, ANALYZER_CLASSES
+except ImportError:
+    iris = None
+
+
+class FakeAnalyzer(object):
+    """Stands in for an analyzer: estimates 1 byte per field it loads."""
+    fields = ()
+    memory_factor = 1.
+    force = False
+    analyzed = ()
+
+    def __init__(self, user, suite, expt, data_type, data_dir, results_dir, filename):
+        self.filename = filename
+
+    def set_config(self, config):
+        pass
+
+    def estimate_memory(self):
+        return len(self.fields)
+
+    def already_analyzed(self):
+        return self.filename in self.analyzed
+
+
+class FakeThetaAnalyzer(FakeAnalyzer):
+    fields = ((0, 4),)
+
+
+class FakeWindAnalyzer(FakeAnalyzer):
+    fields = ((0, 2), (0, 3))
+
+
+@unittest.skipIf(iris is None, 'needs iris')
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        for name, Analyzer in [('fake_theta', FakeThetaAnalyzer), ('fake_wind', FakeWindAnalyzer)]:
+            ANALYZER_CLASSES[name] = None
+            ANALYZERS._loaded[name] = Analyzer
+
+    def tearDown(self):
+        for name in ['fake_theta', 'fake_wind']:
+            del ANALYZER_CLASSES[name]
+            del ANALYZERS._loaded[name]
+        FakeAnalyzer.analyzed = ()
+
+    def make_jobs(self, filenames):
+        return [jobs.Job(analysis, 'user', 'suite', 'expt', 'datam', '/data', '/results',
+                         filename, {})
+                for filename in filenames for analysis in ['fake_theta', 'fake_wind']]
+
+    def test_fields_shared_only_with_cache(self):
+        groups = jobs.group_by_file(self.make_jobs(['a.pp1', 'b.pp1']))
+        self.assertEqual([len(group) for group in groups], [2, 2])
+        self.assertEqual([job.make_analyzer().fields for job in groups[0]],
+                         [((0, 4),), ((0, 2), (0, 3))])
+        self.assertEqual(jobs.estimate_group_memory(groups[0]), 2)
+
+        groups = jobs.group_by_file(self.make_jobs(['a.pp1', 'b.pp1']), share_fields=True)
+        for job in groups[0]:
+            self.assertEqual(job.make_analyzer().fields, ((0, 2), (0, 3), (0, 4)))
+        # Each job loads all three fields.
+        self.assertEqual(jobs.estimate_group_memory(groups[0]), 3)
+
+    def test_analyzed_groups_estimated_as_nothing(self):
+        groups = jobs.group_by_file(self.make_jobs(['a.pp1', 'b.pp1']))
+        FakeAnalyzer.analyzed = ('a.pp1',)
+        self.assertEqual([jobs.estimate_group_memory(group) for group in groups], [0, 2])
+        # A child still to be run holds its parent's results.
+        groups[0][0].children.append(self.make_jobs(['c.pp1'])[0])
+        self.assertEqual(jobs.estimate_group_memory(groups[0]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
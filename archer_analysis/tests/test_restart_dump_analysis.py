@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import iris
+    import synthetic_data
+    from restart_dump_analysis import RestartDumpAnalyzer
+except ImportError:
+    iris = None
+
+
+@unittest.skipIf(iris is None, 'needs iris')
+class TestLevelChunk(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cubes = synthetic_data.make_analyzer_cubes(RestartDumpAnalyzer, nz=7, ny=4, nx=5,
+                                                        ntimes=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_analyzer(self, level_chunk):
+        analyzer = RestartDumpAnalyzer('user', 'suite', 'expt', 'datam', self.tmp_dir,
+                                       self.tmp_dir, 'atmos.000.pp1')
+        analyzer.set_config({'level_chunk': str(level_chunk)})
+        analyzer.set_cubes(self.cubes)
+        analyzer.run()
+        return analyzer
+
+    def test_chunked_matches_unchunked(self):
+        whole = self.run_analyzer(0)
+        # 3 does not divide the 7 levels, so the last block is smaller.
+        chunked = self.run_analyzer(3)
+
+        self.assertEqual(list(chunked.results), list(whole.results))
+        for name in whole.results:
+            np.testing.assert_array_equal(np.asarray(chunked.results[name].data),
+                                          np.asarray(whole.results[name].data), name)
+        for name in ['mse_profile', 'e_t_profile', 'e_q_profile', 'e_z_profile']:
+            np.testing.assert_array_equal(getattr(chunked, name), getattr(whole, name), name)
+        self.assertEqual(chunked.total_mse, whole.total_mse)
+        self.assertEqual(chunked.tcw, whole.tcw)
+        self.assertEqual(chunked.species_max_diffs, whole.species_max_diffs)
+        self.assertEqual(chunked.wv_density_max_diff, whole.wv_density_max_diff)
+
+
+if __name__ == '__main__':
+    unittest.main()
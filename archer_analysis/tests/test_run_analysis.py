@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import iris
+    import run_analysis
+    import synthetic_data
+    import shards
+except ImportError:
+    iris = None
+
+
+@unittest.skipIf(iris is None, 'needs iris')
+class TestConvertToNc(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'atmos.000.pp1')
+        cubes = synthetic_data.make_cubes([(3, 217), (3, 234)], nz=3, ny=4, nx=5, ntimes=2)
+        iris.save(cubes, self.filename, saver='pp')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_convert_whole_file(self):
+        converted_filename = run_analysis.convert_to_nc(self.filename)
+        self.assertEqual(converted_filename, self.filename + '.nc')
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['atmos.000.pp1', 'atmos.000.pp1.nc', 'atmos.000.pp1.nc.done'])
+        self.assertEqual(len(iris.load(converted_filename)), 2)
+
+
+class FakeJob(object):
+    def __init__(self, name, results_dir):
+        self.name = name
+        self.results_dir = results_dir
+        self.output_filename = name + '.nc'
+        self.config = {}
+        self.children = []
+
+    def __repr__(self):
+        return self.name
+
+    def make_analyzer(self):
+        return self
+
+
+@unittest.skipIf(iris is None, 'needs iris')
+class TestMergeShardResults(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jobs_filename = os.path.join(self.tmp_dir, 'analysis_jobs.jsonl')
+        self.timings_filename = os.path.join(self.tmp_dir, 'analysis_timings.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_records(self, shard, records):
+        with open(shards.shard_log_filename(self.jobs_filename, shard), 'a') as f:
+            for run_finished, job, status in records:
+                f.write(json.dumps({'run_finished': run_finished, 'stage': 'analysis',
+                                    'job': job, 'status': status, 'error': None}) + '\n')
+
+    def test_latest_records_and_missing_jobs(self):
+        # The first run of shard 0 failed J1; it was run again and analyzed it.
+        self.write_records((0, 2), [('2026-01-01T00:00', 'J1', 'failed'),
+                                    ('2026-01-01T00:00', 'J2', 'claimed'),
+                                    ('2026-01-02T00:00', 'J1', 'analyzed')])
+        self.write_records((1, 2), [('2026-01-01T00:00', 'J2', 'analyzed')])
+        root_jobs = [FakeJob(name, self.tmp_dir) for name in ['J1', 'J2', 'J3', 'J4']]
+        # J4 was analyzed before the shards' logs were last merged; J3 was never run.
+        open(os.path.join(self.tmp_dir, 'J4.nc'), 'w').close()
+
+        rc = run_analysis.RunControl()
+        reported = []
+        rc.report = lambda job_results, **kwargs: reported.extend(job_results)
+        rc.merge_shard_results(self.timings_filename, self.jobs_filename, root_jobs)
+        self.assertEqual(sorted((str(r.job), r.status) for r in reported),
+                         [('J1', 'analyzed'), ('J2', 'analyzed'), ('J3', 'failed')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import iris
+    import synthetic_data
+    from surf_flux_analysis import SurfFluxAnalyzer
+except ImportError:
+    iris = None
+
+
+@unittest.skipIf(iris is None, 'needs iris')
+class TestAppendToPrevious(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_appends_to_saved_time_series(self):
+        analyzer = SurfFluxAnalyzer('user', 'suite', 'expt', 'dataw', self.tmp_dir, self.tmp_dir,
+                                    'atmos.pp3')
+        fluxes = list(synthetic_data.make_cubes(SurfFluxAnalyzer.fields, nz=2, ny=4, nx=5,
+                                                ntimes=6))
+        tss = [flux.collapsed(['grid_latitude', 'grid_longitude'], iris.analysis.MEAN)
+               for flux in fluxes]
+        # A first run on the first 4 time steps, saved and reloaded as the next run sees it.
+        iris.save([ts[:4] for ts in tss],
+                  os.path.join(self.tmp_dir, analyzer.output_filename))
+
+        joined = analyzer._append_to_previous(fluxes, [ts[4:] for ts in tss])
+
+        self.assertEqual(len(joined), 3)
+        for ts, joined_ts in zip(tss, joined):
+            self.assertEqual(joined_ts.shape, (6, ))
+            self.assertTrue((joined_ts.coord('time').points == ts.coord('time').points).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import iris
+    import synthetic_data
+    from analyzers import ANALYZERS
+    from benchmarks import ANALYZER_CONFIG
+    from utils import get_cube, get_cube_from_attr
+except ImportError:
+    iris = None
+
+
+@unittest.skipIf(iris is None, 'needs iris')
+class TestMakeAnalyzerCubes(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cubes_have_analyzer_fields_and_inputs(self):
+        for analysis in ANALYZERS:
+            Analyzer = ANALYZERS[analysis]
+            cubes = synthetic_data.make_analyzer_cubes(Analyzer, nz=4, ny=6, nx=8, ntimes=2)
+            for section, item in Analyzer.fields:
+                get_cube(cubes, section, item)
+            for input_id in Analyzer.inputs:
+                get_cube_from_attr(cubes, 'id', input_id)
+
+    def test_analyzers_run_on_cubes(self):
+        for analysis in ANALYZERS:
+            Analyzer = ANALYZERS[analysis]
+            cubes = synthetic_data.make_analyzer_cubes(Analyzer, nz=4, ny=6, nx=8, ntimes=2)
+            analyzer = Analyzer('user', 'suite', 'expt', 'datam', self.tmp_dir, self.tmp_dir,
+                                'atmos.000.pp1')
+            analyzer.set_config(ANALYZER_CONFIG.get(analysis, {}))
+            analyzer.set_cubes(cubes)
+            analyzer.run()
+            self.assertTrue(analyzer.results, analysis)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import iris
+    from timeseries import concatenate_results
+except ImportError:
+    iris = None
+
+
+def make_results(hour):
+    """Results of one file: a profile at one time, with the scalar coords of a UM field."""
+    cube = iris.cube.Cube(np.arange(3.) + hour, long_name='theta_profile', units='K',
+                          attributes={'id': 'theta_profile'})
+    cube.add_dim_coord(iris.coords.DimCoord(np.arange(3.), long_name='level_height', units='m'),
+                       0)
+    cube.add_aux_coord(iris.coords.DimCoord(hour, standard_name='time',
+                                            units='hours since 2000-01-01'))
+    cube.add_aux_coord(iris.coords.DimCoord(hour, standard_name='forecast_period',
+                                            units='hours'))
+    cube.add_aux_coord(iris.coords.DimCoord(0., standard_name='forecast_reference_time',
+                                            units='hours since 2000-01-01'))
+    return cube
+
+
+@unittest.skipIf(iris is None, 'needs iris')
+class TestConcatenateResults(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_filename = os.path.join(self.tmp_dir, 'expt.profile.timeseries.nc')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def save_results(self, hours):
+        filenames = []
+        for hour in hours:
+            filename = os.path.join(self.tmp_dir, 'atmos.{:03d}.nc'.format(hour))
+            iris.save(make_results(hour), filename)
+            filenames.append(filename)
+        return filenames
+
+    def test_per_file_forecast_period(self):
+        filenames = self.save_results([0, 6, 12])
+        self.assertEqual(concatenate_results(filenames, self.output_filename), 3)
+        cube = iris.load_cube(self.output_filename)
+        self.assertEqual(cube.shape, (3, 3))
+        np.testing.assert_array_equal(cube.coord('time').points, [0, 6, 12])
+        np.testing.assert_array_equal(cube.coord('forecast_period').points, [0, 6, 12])
+        self.assertEqual(cube.coord_dims('forecast_period'), cube.coord_dims('time'))
+
+        # A new file is appended to the saved time series.
+        filenames += self.save_results([18])
+        self.assertEqual(concatenate_results(filenames, self.output_filename), 1)
+        cube = iris.load_cube(self.output_filename)
+        np.testing.assert_array_equal(cube.coord('forecast_period').points, [0, 6, 12, 18])
+        np.testing.assert_array_equal(cube.data[:, 0], [0, 6, 12, 18])
+
+    def test_fields_left_out(self):
+        filename = os.path.join(self.tmp_dir, 'atmos.000.nc')
+        field = iris.cube.Cube(np.zeros((1, 2, 2)), long_name='mse', attributes={'id': 'mse'})
+        field.add_dim_coord(iris.coords.DimCoord([0.], standard_name='time',
+                                                 units='hours since 2000-01-01'), 0)
+        iris.save([make_results(0), field], filename)
+        concatenate_results([filename], self.output_filename)
+        self.assertEqual([cube.name() for cube in iris.load(self.output_filename)],
+                         ['theta_profile'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import itertools
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+
+class TestCountBlobsMask(unittest.TestCase):
+    def test_matches_bfs(self):
+        """The vectorised labelling gives exactly the labels of the reference implementation."""
+        random = np.random.RandomState(0)
+        masks = [random.rand(13, 17) < fraction for fraction in [0.1, 0.3, 0.5, 0.7]]
+        masks.append(np.zeros((5, 6), dtype=bool))
+        masks.append(np.ones((5, 6), dtype=bool))
+        for mask, diagonal, wrap, extended in itertools.product(masks, [False, True],
+                                                                [False, True], [False, True]):
+            expected = utils.count_blobs_mask_bfs(mask, diagonal, wrap, extended)
+            actual = utils.count_blobs_mask(mask, diagonal, wrap, extended)
+            self.assertEqual(actual[0], expected[0])
+            np.testing.assert_array_equal(actual[1], expected[1])
+
+
+class TestBlobStats(unittest.TestCase):
+    def test_matches_masks(self):
+        """The same statistics as masking each blob in turn, for blobs not crossing an edge."""
+        random = np.random.RandomState(0)
+        mask = random.rand(20, 30) < 0.4
+        # Keep the blobs off the edges.
+        mask[[0, -1], :] = False
+        mask[:, [0, -1]] = False
+        data = random.standard_normal(mask.shape)
+        max_blob_index, blobs = utils.count_blobs_mask(mask, True)
+        area, total, maximum, centroid_y, centroid_x = utils.blob_stats(blobs, max_blob_index,
+                                                                        data)
+        self.assertEqual(len(area), max_blob_index)
+        for i in range(1, max_blob_index + 1):
+            blob_mask = (blobs == i)
+            y, x = np.nonzero(blob_mask)
+            self.assertEqual(area[i - 1], blob_mask.sum())
+            self.assertAlmostEqual(total[i - 1], data[blob_mask].sum())
+            self.assertEqual(maximum[i - 1], data[blob_mask].max())
+            self.assertAlmostEqual(centroid_y[i - 1], y.mean())
+            self.assertAlmostEqual(centroid_x[i - 1], x.mean())
+
+    def test_l_shaped_blob(self):
+        blobs = np.zeros((10, 10), dtype=int)
+        blobs[0:4, 1] = 1
+        blobs[3, 1:5] = 1
+        _, _, _, centroid_y, centroid_x = utils.blob_stats(blobs, 1, np.ones(blobs.shape))
+        y, x = np.nonzero(blobs)
+        self.assertAlmostEqual(centroid_y[0], y.mean())
+        self.assertAlmostEqual(centroid_x[0], x.mean())
+
+    def test_blob_crossing_edge(self):
+        blobs = np.zeros((10, 10), dtype=int)
+        # Rows 8, 9, 0 and 1 of column 5: centred half way between rows 9 and 0.
+        blobs[[8, 9, 0, 1], 5] = 1
+        _, _, _, centroid_y, centroid_x = utils.blob_stats(blobs, 1, np.ones(blobs.shape))
+        self.assertAlmostEqual(centroid_y[0], 9.5)
+        self.assertAlmostEqual(centroid_x[0], 5)
+        _, _, _, centroid_y, _ = utils.blob_stats(blobs, 1, np.ones(blobs.shape), wrap=False)
+        self.assertAlmostEqual(centroid_y[0], 4.5)
+
+
+class TestMassWeightedVerticalIntegrals(unittest.TestCase):
+    def test_matches_explicit_sum(self):
+        """The same integrals as the explicit sum of dz3d * rho * var_on_rho (as _calc_mwvi did),
+        with the bottom rho level taking the bottom theta level's value."""
+        random = np.random.RandomState(0)
+        nlev = 6
+        rho = random.uniform(size=(nlev, 4, 5)).astype(np.float32)
+        on_theta = random.uniform(size=(nlev + 1, 4, 5)).astype(np.float32)
+        on_rho = random.uniform(size=(nlev, 4, 5)).astype(np.float32)
+        dz = random.uniform(10, 100, size=nlev)
+        dz3d = dz.repeat(4 * 5).reshape(nlev, 4, 5)
+
+        theta_on_rho = (on_theta[:-1] + on_theta[1:]) / 2
+        theta_on_rho[0] = on_theta[0]
+        expected = [(dz3d * (theta_on_rho * rho)).sum(axis=0),
+                    (dz3d * (on_rho * rho)).sum(axis=0)]
+        actual = utils.mass_weighted_vertical_integrals(rho, [on_theta, on_rho], dz)
+        np.testing.assert_allclose(actual, expected, rtol=1e-12)
+        # Above the surface, the bottom rho level is averaged like the others.
+        theta_on_rho[0] = (on_theta[0] + on_theta[1]) / 2
+        actual = utils.mass_weighted_vertical_integrals(rho, [on_theta], dz, from_surface=False)
+        np.testing.assert_allclose(actual[0], (dz3d * (theta_on_rho * rho)).sum(axis=0),
+                                   rtol=1e-12)
+
+    def test_chunked_matches_whole_column(self):
+        """Adding up blocks of levels, as RestartDumpAnalyzer's level_chunk does, gives the
+        same integrals as one call over the whole column."""
+        random = np.random.RandomState(0)
+        nlev = 7
+        rho = random.uniform(size=(nlev, 4, 5)).astype(np.float32)
+        variables = [random.uniform(size=(nlev + 1, 4, 5)).astype(np.float32) for _ in range(3)]
+        variables.append(random.uniform(size=(nlev, 4, 5)).astype(np.float32))
+        dz = random.uniform(10, 100, size=nlev)
+        whole = utils.mass_weighted_vertical_integrals(rho, variables, dz)
+
+        chunked = None
+        for start in range(0, nlev, 3):
+            end = min(start + 3, nlev)
+            block = [var[start:end + 1] if len(var) == nlev + 1 else var[start:end]
+                     for var in variables]
+            chunked = utils.mass_weighted_vertical_integrals(
+                rho[start:end], block, dz[start:end], from_surface=(start == 0), out=chunked)
+        np.testing.assert_array_equal(chunked, whole)
+
+
+if __name__ == '__main__':
+    unittest.main()
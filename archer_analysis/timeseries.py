@@ -0,0 +1,151 @@
+"""Join the results of an analysis on each file of a run into time series over the whole run."""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import iris
+
+from manifest import file_identity, read_manifest, write_manifest
+
+
+def _cube_key(cube):
+    return cube.attributes.get('id', cube.name())
+
+
+def _with_time_dim(cube):
+    """cube with time as a dimension, or None if it has no time coordinate."""
+    if not cube.coords('time'):
+        return None
+    if cube.coord_dims('time'):
+        return cube
+    # e.g. a field from a single dump, or a profile averaged over the file's times.
+    return iris.util.new_axis(cube, 'time')
+
+
+def _promote_varying_scalar_coords(cubes):
+    """Make scalar coordinates that differ between cubes of the same series (e.g. the
+    forecast_period of the fields of each file) auxiliary coordinates along time, repeated for
+    each time, so that the cubes can be concatenated.
+
+    A coordinate missing from some of the cubes is removed from all of them.
+    """
+    names = set(coord.name() for cube in cubes for coord in cube.coords())
+    names.discard('time')
+    for name in names:
+        if not all(cube.coords(name) for cube in cubes):
+            for cube in cubes:
+                if cube.coords(name):
+                    cube.remove_coord(name)
+            continue
+        coords = [cube.coord(name) for cube in cubes]
+        scalar = [not cube.coord_dims(coord) for cube, coord in zip(cubes, coords)]
+        if not any(scalar) or (all(scalar) and all(coord == coords[0] for coord in coords)):
+            continue
+        for cube, coord, is_scalar in zip(cubes, coords, scalar):
+            if not is_scalar:
+                continue
+            time_dim, = cube.coord_dims('time')
+            ntimes = cube.shape[time_dim]
+            bounds = None if coord.bounds is None else np.repeat(coord.bounds, ntimes, axis=0)
+            along_time = iris.coords.AuxCoord.from_coord(coord).copy(
+                points=np.repeat(coord.points, ntimes), bounds=bounds)
+            cube.remove_coord(coord)
+            cube.add_aux_coord(along_time, time_dim)
+
+
+def _read_results(filename):
+    """(first time, OrderedDict of id: cube with a time dimension) of a results file.
+
+    Only cubes with at most one dimension besides time (scalars and profiles) are kept: the
+    time series are rewritten each time files are added to them, which would be far too costly
+    for whole fields.
+    """
+    cubes = OrderedDict()
+    for cube in iris.load(filename):
+        cube = _with_time_dim(cube)
+        if cube is not None and cube.ndim <= 2:
+            cubes[_cube_key(cube)] = cube
+    times = [cube.coord('time').points[0] for cube in cubes.values()]
+    return min(times) if times else None, cubes
+
+
+def _read_all_results(filenames):
+    """(first time, cubes) of each results file with any cubes over time, in time order."""
+    results = []
+    for filename in filenames:
+        time, cubes = _read_results(filename)
+        if cubes:
+            results.append((time, filename, cubes))
+    results.sort(key=lambda result: result[:2])
+    return [(time, cubes) for time, _, cubes in results]
+
+
+def _last_time(cubes):
+    return max(cube.coord('time').points[-1] for cube in cubes)
+
+
+def sources_filename(output_filename):
+    return output_filename + '.sources'
+
+
+def concatenate_results(filenames, output_filename):
+    """Concatenate the cubes in the results files filenames along time into output_filename.
+
+    Cubes are matched by id (or name); those without a time coordinate, or with more than one
+    other dimension, are left out. The files are read one at a time, in time order, and their
+    data only when it is written.
+    What went into output_filename is recorded next to it, so that when the files it was made
+    from are unchanged, only new files are read, and output_filename is rewritten with them
+    appended to its time series, as long as they come after the times already in it.
+    Otherwise it is rebuilt from all the files.
+    Returns the number of files read.
+    """
+    identities = dict((filename, file_identity(filename)) for filename in filenames)
+    sources = read_manifest(sources_filename(output_filename))
+    previous = []
+    included = []
+    if (sources is not None and os.path.exists(output_filename) and
+            sources['output'] == file_identity(output_filename) and
+            all(identities.get(f) == identity for f, identity in sources['files'].items())):
+        included = list(sources['files'])
+    new_filenames = [f for f in filenames if f not in included]
+    if not new_filenames:
+        return 0
+
+    new_results = _read_all_results(new_filenames)
+    if included:
+        previous = iris.load(output_filename)
+        if previous and new_results and new_results[0][0] <= _last_time(previous):
+            # A file from earlier in the run has turned up: start again.
+            previous = []
+            included = []
+            new_filenames = filenames
+            new_results = _read_all_results(filenames)
+
+    series = OrderedDict((_cube_key(cube), [cube]) for cube in previous)
+    for _, cubes in new_results:
+        for key, cube in cubes.items():
+            series.setdefault(key, []).append(cube)
+
+    joined = iris.cube.CubeList()
+    for key, cubes in series.items():
+        latest = cubes[-1]
+        for cube in cubes[:-1]:
+            # History and the like differ between files, and previous results may have been
+            # saved with a narrower type (see output_float32).
+            cube.attributes = latest.attributes
+            if cube.dtype != latest.dtype:
+                cube.data = cube.data.astype(latest.dtype)
+        _promote_varying_scalar_coords(cubes)
+        joined.append(iris.cube.CubeList(cubes).concatenate_cube())
+
+    if joined:
+        # Write then rename: the previous time series are read from output_filename as it is
+        # written.
+        tmp_filename = output_filename + '.tmp.nc'
+        iris.save(joined, tmp_filename)
+        os.rename(tmp_filename, output_filename)
+        write_manifest(sources_filename(output_filename),
+                       {'output': file_identity(output_filename),
+                        'files': dict((f, identities[f]) for f in included + new_filenames)})
+    return len(new_filenames)
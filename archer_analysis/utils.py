@@ -5,25 +5,53 @@ def is_power_of_two(num):
     return num & (num - 1) == 0
 
 
-def coarse_grain(data, mask):
+def get_pyplot():
+    """matplotlib.pyplot with a non-interactive backend.
+
+    Imported when first plotting, rather than at module level, as it is slow to import.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def divisors(num):
+    return [d for d in range(1, num + 1) if num % d == 0]
+
+
+def coarse_grain(data, mask, block_sizes=None):
+    """Sum data where mask is True over square blocks at several scales.
+
+    block_sizes is a list of block widths in cells, each of which must divide both dimensions
+    of data (which need not be square); by default all common divisors are used. Each scale is
+    derived from the finest already calculated scale whose block size divides it, by
+    reshaping and summing, so the whole pyramid costs little more than one pass over data.
+    Returns a list of (n, coarse) tuples, where n is the number of blocks along the first
+    axis, in order of increasing n.
+    """
     assert data.ndim == 2
-    assert data.shape[0] == data.shape[1]
-    assert is_power_of_two(data.shape[0])
+    assert data.shape == mask.shape
+    ny, nx = data.shape
+
+    if block_sizes is None:
+        block_sizes = [d for d in divisors(ny) if nx % d == 0]
+    block_sizes = sorted(set(block_sizes))
+    for block_size in block_sizes:
+        if ny % block_size or nx % block_size:
+            raise Exception('Block size {} does not divide domain {}'.format(block_size, data.shape))
 
-    nx = data.shape[0]
-    pow = int(np.log2(data.shape[0]))
+    levels = {1: np.where(mask.astype(bool), data, 0).astype(np.float64)}
+    for block_size in block_sizes:
+        if block_size in levels:
+            continue
+        finer_size = max(s for s in levels if block_size % s == 0)
+        finer = levels[finer_size]
+        factor = block_size // finer_size
+        levels[block_size] = finer.reshape(finer.shape[0] // factor, factor,
+                                           finer.shape[1] // factor, factor).sum(axis=(1, 3))
 
-    coarse_data = []
-    for n in 2**np.arange(pow + 1):
-	coarse = np.zeros((n, n))
-	l = nx / n
-	for i in range(n):
-	    s1 = slice(i * l, (i + 1) * l)
-	    for j in range(n):
-		s2 = slice(j * l, (j + 1) * l)
-		coarse[i, j] = data[s1, s2][mask[s1, s2]].sum()
-	coarse_data.append((n, coarse))
-    return coarse_data
+    return [(ny // s, levels[s]) for s in reversed(block_sizes)]
 
 
 def test_indices(i, j, diagonal=False, extended=False):
@@ -42,7 +70,8 @@ def test_indices(i, j, diagonal=False, extended=False):
     return indices
 
 
-def count_blobs_mask(mask, diagonal=False, wrap=True):
+def count_blobs_mask_bfs(mask, diagonal=False, wrap=True, extended=False):
+    """Reference (pure python, breadth first search) implementation of count_blobs_mask."""
     blobs = np.zeros_like(mask, dtype=np.int32)
     blob_index = 0
     for j in range(mask.shape[1]):
@@ -57,7 +86,7 @@ def count_blobs_mask(mask, diagonal=False, wrap=True):
                 while outers:
                     new_outers = []
                     for ii, jj in outers:
-                        for it, jt in test_indices(ii, jj, diagonal):
+                        for it, jt in test_indices(ii, jj, diagonal, extended):
                             if not wrap:
                                 if it < 0 or it >= mask.shape[0] or\
                                    jt < 0 or jt >= mask.shape[1]:
@@ -74,7 +103,191 @@ def count_blobs_mask(mask, diagonal=False, wrap=True):
     return blob_index, blobs
 
 
+def _neighbour_slices(offset, size):
+    # Slices selecting cells and their neighbours at offset along one (non-periodic) axis.
+    return (slice(max(0, -offset), size - max(0, offset)),
+            slice(max(0, offset), size + min(0, offset)))
+
+
+def count_blobs_mask(mask, diagonal=False, wrap=True, extended=False):
+    """Label connected blobs in a 2D mask.
+
+    Adjacency is the same as for test_indices. If wrap is True, the domain is treated as
+    doubly-periodic, and blobs touching opposite edges are merged.
+    Returns the number of blobs and an array of blob labels (1 to max_blob_index, 0 for
+    no blob). Blobs are numbered in the order they are first found scanning down each
+    column in turn, i.e. exactly as count_blobs_mask_bfs numbers them.
+    """
+    # Imported here so that analyzers that do not label blobs do not pay for importing scipy.
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    assert mask.ndim == 2
+    mask = mask.astype(bool)
+    blobs = np.zeros_like(mask, dtype=np.int32)
+    ncells = mask.sum()
+    if not ncells:
+        return 0, blobs
+
+    # Give each masked cell a node index, numbered in column-major order.
+    nodes = -np.ones(mask.shape, dtype=np.int64)
+    nodes.T[mask.T] = np.arange(ncells)
+
+    # Every adjacent pair of masked cells is an edge in a graph; the blobs are the connected
+    # components of this graph. Each offset only needs to be used in one direction.
+    offsets = set(test_indices(0, 0, diagonal, extended)) - set([(0, 0)])
+    offsets = [o for o in offsets if o > (0, 0)]
+
+    srcs = []
+    dsts = []
+    for di, dj in offsets:
+        if wrap:
+            src = nodes
+            dst = np.roll(np.roll(nodes, -di, axis=0), -dj, axis=1)
+        else:
+            src_i, dst_i = _neighbour_slices(di, mask.shape[0])
+            src_j, dst_j = _neighbour_slices(dj, mask.shape[1])
+            src = nodes[src_i, src_j]
+            dst = nodes[dst_i, dst_j]
+        edge = (src >= 0) & (dst >= 0)
+        srcs.append(src[edge])
+        dsts.append(dst[edge])
+
+    srcs = np.concatenate(srcs)
+    dsts = np.concatenate(dsts)
+    graph = coo_matrix((np.ones(len(srcs), dtype=np.int8), (srcs, dsts)), shape=(ncells, ncells))
+    max_blob_index, labels = connected_components(graph, directed=False)
+
+    # Renumber components in order of their first (column-major) cell.
+    _, first_nodes = np.unique(labels, return_index=True)
+    blob_indices = np.empty(max_blob_index, dtype=np.int32)
+    blob_indices[np.argsort(first_nodes)] = np.arange(1, max_blob_index + 1)
+
+    blobs.T[mask.T] = blob_indices[labels]
+    return max_blob_index, blobs
+
+
+def blob_stats(blobs, max_blob_index, data, wrap=True):
+    """Calculate statistics of data for all blobs from count_blobs_mask at once.
+
+    Returns arrays, indexed by blob_index - 1, of: area (number of cells), sum and max of data
+    over each blob, and centroid (as fractional i, j indices, the mean of its cells' indices).
+    If wrap is True, a blob that touches both edges of an axis is taken to cross them: its
+    indices along that axis are unwrapped across its widest gap before taking their mean.
+    """
+    assert blobs.shape == data.shape
+    labels = blobs.ravel()
+    values = np.asarray(data).ravel()
+    nbins = max_blob_index + 1
+
+    area = np.bincount(labels, minlength=nbins)[1:]
+    total = np.bincount(labels, weights=values, minlength=nbins)[1:]
+
+    # Sort the cells in blobs by label, then each blob is a contiguous run.
+    cells = np.flatnonzero(labels > 0)
+    cells = cells[np.argsort(labels[cells], kind='mergesort')]
+    starts = np.concatenate([[0], np.cumsum(area)[:-1]])
+    if max_blob_index:
+        maximum = np.maximum.reduceat(values[cells], starts)
+    else:
+        maximum = np.zeros(0, dtype=values.dtype)
+
+    centroid = []
+    indices = np.indices(blobs.shape)
+    for axis, size in enumerate(blobs.shape):
+        index = indices[axis].ravel()
+        index_sum = np.bincount(labels, weights=index, minlength=nbins)[1:]
+        if wrap and size > 1:
+            at_start = np.bincount(labels[index == 0], minlength=nbins)[1:] > 0
+            at_end = np.bincount(labels[index == size - 1], minlength=nbins)[1:] > 0
+            for blob in np.flatnonzero(at_start & at_end):
+                blob_index = index[cells[starts[blob]:starts[blob] + area[blob]]]
+                occupied = np.zeros(size, dtype=bool)
+                occupied[blob_index] = True
+                free = np.flatnonzero(~occupied)
+                if not len(free):
+                    # Fills the whole axis: no way to tell where it starts.
+                    continue
+                gaps = np.split(free, np.flatnonzero(np.diff(free) > 1) + 1)
+                widest = max(gaps, key=len)
+                # Move the cells before the gap after the ones beyond it.
+                index_sum[blob] += size * (blob_index < widest[0]).sum()
+        centroid.append(index_sum / np.maximum(area, 1) % size)
+
+    return area, total, maximum, centroid[0], centroid[1]
+
+
+def mass_weighted_vertical_integrals(rho, variables, dz, from_surface=True, out=None):
+    """Integrate rho * var over height for several fields at once, in one pass up the column.
+
+    rho is on rho levels, with height as its first dimension. Each of variables is either on
+    the same levels, or on the theta levels (one more level) half way between them, in which
+    case it is averaged onto the rho levels. dz is the depth of each rho level (the spacing
+    of the theta levels). Returns an array with one column integral for each of variables
+    (each the shape of a horizontal slice of rho), or adds them to out if it is given.
+    Set from_surface=False if rho and variables are a block of levels above the surface.
+    """
+    nlev = rho.shape[0]
+    for var in variables:
+        if var.shape[0] not in (nlev, nlev + 1):
+            raise Exception('Variable with {} levels not on rho or theta levels'.format(var.shape[0]))
+    if out is None:
+        out = np.zeros((len(variables),) + rho.shape[1:])
+
+    for level in range(nlev):
+        var_on_rho = []
+        for var in variables:
+            if var.shape[0] == nlev:
+                var_on_rho.append(var[level])
+            elif level == 0 and from_surface:
+                # Assume bottom rho level value equal to bottom theta level value
+                # cf:
+                # https://code.metoffice.gov.uk/trac/um/browser/main/branches/dev/chrissmith/
+                # vn10.5_ium_base/src/atmosphere/energy_correction/
+                # vert_eng_massq-vrtemq1b.F90?rev=24919#L297
+                # N.B. has no effect on outcome for data that I have analysed so far:
+                # np.isclose(var.data[:, 0], var.data[:, 1]).all() == True
+                # Therefore adding and averaging is the same as just taking one of them.
+                var_on_rho.append(var[0])
+            else:
+                var_on_rho.append((var[level] + var[level + 1]) / 2)
+        # dz[level:level + 1] rather than dz[level], so the product is done at dz's precision.
+        out += dz[level:level + 1] * (np.array(var_on_rho) * rho[level])
+    return out
+
+
+class CubeIndex(object):
+    """Index of cubes by STASH (section, item) and by attribute, for O(1) lookups."""
+    def __init__(self, cubes):
+        self.cubes = cubes
+        self.stash_index = {}
+        self.attr_index = {}
+        # setdefault: first match wins, as it would when searching through cubes.
+        for cube in cubes:
+            for key, value in cube.attributes.items():
+                try:
+                    self.attr_index.setdefault((key, value), cube)
+                except TypeError:
+                    # Unhashable value (e.g. array); can only be found by searching.
+                    pass
+            if 'STASH' in cube.attributes:
+                stash = cube.attributes['STASH']
+                self.stash_index.setdefault((stash.section, stash.item), cube)
+
+    def __iter__(self):
+        return iter(self.cubes)
+
+    def __len__(self):
+        return len(self.cubes)
+
+
 def get_cube_from_attr(cubes, key, value):
+    if isinstance(cubes, CubeIndex):
+        try:
+            return cubes.attr_index[(key, value)]
+        except (KeyError, TypeError):
+            # Not indexed; search below (raises if not there).
+            pass
     for cube in cubes:
 	if key in cube.attributes:
 	    if cube.attributes[key] == value:
@@ -83,6 +296,10 @@ def get_cube_from_attr(cubes, key, value):
 
 
 def get_cube(cubes, section, item):
+    if isinstance(cubes, CubeIndex):
+        if (section, item) in cubes.stash_index:
+            return cubes.stash_index[(section, item)]
+        raise Exception('Cube ({}, {}) not found'.format(section, item))
     for cube in cubes:
         stash = cube.attributes['STASH']
         if stash.section == section and stash.item == item: